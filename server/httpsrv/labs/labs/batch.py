@@ -0,0 +1,182 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import labs
+import cost
+from cost import admit, estimate
+from forkpool import die_with_parent
+
+# request parameters the analytic solution of each lab depends on besides
+# the problem, jobs sharing them share one analytic grid
+ANALYTIC_KEYS = {
+    5: ('N', 'K', 'T'),
+    6: ('N', 'K', 'T'),
+    7: ('N', 'l'),
+    8: ('N1', 'N2', 'K', 'T'),
+}
+
+
+def _solve(lab_id, data, numerical, analytic):
+    return labs.LABS[lab_id](data, numerical=numerical, analytic=analytic)
+
+
+def _analytic_key(data, lab_id):
+    return tuple(int(data[key]) for key in ANALYTIC_KEYS[lab_id]) + (data.get('dtype', 'float64'),) + \
+        labs.problem_key(data)
+
+
+def _self_contained(data):
+    return bool(data.get('adaptive') or data.get('probes'))
+
+
+def _merge(lab_id, numerical, analytic, admission):
+    if 'error' in numerical:
+        return numerical
+    if 'error' in analytic:
+        return analytic
+
+    resp = dict(numerical)
+    u = analytic['analytic']
+    if lab_id in (5, 6):
+        first = resp.get('first_step', 0)
+        u = u[first:first + len(resp['numerical'])]
+    resp['analytic'] = u
+    if admission is not None:
+        resp['admission'] = admission
+    return resp
+
+
+def _result(future):
+    try:
+        return future.result()
+    except Exception as e:
+        return {'error': str(e)}
+
+
+def solve_batch(request, lab_id, out):
+    """
+    Solves a list of jobs of one lab across a process pool. The batch is
+    held to the budgets of one request: jobs over the time budget in total
+    are rejected, so are jobs whose results would not fit the memory budget
+    of the response, and jobs run together only while their memory fits
+    next to the results held.
+
+    request: {'jobs': [data, ...], 'workers': int, 'stream': bool}
+    Analytic grids are computed once per distinct grid.
+    With stream the results are written as NDJSON lines
+    {'index': i, 'result': resp} as soon as they are ready,
+    otherwise as {'results': [resp, ...]} in input order.
+    """
+    jobs = request['jobs']
+    workers = int(request.get('workers') or os.cpu_count())
+    stream = bool(request.get('stream', False))
+
+    # streamed results are written and dropped, the others are kept for the response
+    results = None if stream else [None] * len(jobs)
+
+    def finish(index, resp):
+        if not stream:
+            results[index] = resp
+        else:
+            out.write(f'{{"index": {index}, "result": ')
+            labs.dump(resp, out)
+            out.write('}\n')
+            out.flush()
+
+    # jobs run in parallel, so their estimated times add up over the workers
+    parallel = min(workers, os.cpu_count())
+    batch_time = 0.0
+    stored = 0
+    admitted = {}
+    groups = {}
+    for index, job in enumerate(jobs):
+        try:
+            # results travel back from the pool pickled, spilled arrays would be read whole,
+            # so jobs run and are admitted without spill
+            data, admission = admit(dict(job, spill=False), lab_id)
+            key = _analytic_key(data, lab_id)
+            job_cost = estimate(data, lab_id)
+        except Exception as e:
+            finish(index, {'error': str(e)})
+            continue
+        if (batch_time + job_cost.time) / parallel > cost.TIME_BUDGET:
+            finish(index, {'error': f"Batch is over budget: the jobs before this one are estimated "
+                                    f"at {batch_time / parallel:.1f} s, allowed {cost.TIME_BUDGET:.1f} s"})
+            continue
+        if not stream and stored + job_cost.memory > cost.MEMORY_BUDGET:
+            finish(index, {'error': f"Batch is over budget: the results before this one are estimated "
+                                    f"at {stored / 2 ** 20:.1f} MiB, allowed {cost.MEMORY_BUDGET / 2 ** 20:.1f} MiB"})
+            continue
+        batch_time += job_cost.time
+        if not stream:
+            stored += job_cost.memory
+        admitted[index] = (data, admission, job_cost.memory)
+        # adaptive steps and probe times are only known after the solve,
+        # so the analytic solution is computed by the job itself
+        if _self_contained(data):
+            continue
+        groups.setdefault(key, []).append(index)
+
+    tasks = deque()
+    for index, (data, _, memory) in admitted.items():
+        if _self_contained(data):
+            tasks.append(('complete', index, data, True, True, memory))
+        else:
+            tasks.append(('numerical', index, data, True, False, memory))
+    for key, indices in groups.items():
+        data, _, memory = admitted[indices[0]]
+        tasks.append(('analytic', key, data, False, True, memory))
+
+    numerical = {}
+    analytic = {}
+    # jobs of each analytic grid still to finish, the grid is dropped after the last one
+    remaining = {key: len(indices) for key, indices in groups.items()}
+    with ProcessPoolExecutor(max_workers=workers, initializer=die_with_parent, initargs=(os.getpid(),)) as pool:
+        running = {}
+        # estimated memory of the running tasks and of the results held here
+        used = 0
+        while tasks or running:
+            # tasks run together only while their estimated memory fits the budget of one request
+            while tasks and len(running) < workers and (not running or used + tasks[0][5] <= cost.MEMORY_BUDGET):
+                kind, tag, data, with_numerical, with_analytic, memory = tasks.popleft()
+                future = pool.submit(_solve, lab_id, data, with_numerical, with_analytic)
+                running[future] = (kind, tag, memory)
+                used += memory
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, tag, memory = running.pop(future)
+                if kind == 'complete':
+                    resp = _result(future)
+                    if 'error' not in resp and admitted[tag][1] is not None:
+                        resp['admission'] = admitted[tag][1]
+                    finish(tag, resp)
+                    if stream:
+                        used -= memory
+                    continue
+                elif kind == 'numerical':
+                    numerical[tag] = _result(future)
+                    ready = [tag] if _analytic_key(admitted[tag][0], lab_id) in analytic else []
+                else:
+                    analytic[tag] = _result(future)
+                    ready = [index for index in groups[tag] if index in numerical]
+
+                for index in ready:
+                    data, admission, memory = admitted[index]
+                    key = _analytic_key(data, lab_id)
+                    finish(index, _merge(lab_id, numerical.pop(index), analytic[key], admission))
+                    if stream:
+                        used -= memory
+                    remaining[key] -= 1
+                    if not remaining[key]:
+                        del analytic[key]
+                        used -= admitted[groups[key][0]][2]
+
+    if not stream:
+        out.write('{"results": [')
+        for index, resp in enumerate(results):
+            if index:
+                out.write(', ')
+            labs.dump(resp, out)
+        out.write(']}')
@@ -0,0 +1,141 @@
+import os
+import glob
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+
+STATE_DIR = os.environ.get('LABS_STATE_DIR', os.path.join(tempfile.gettempdir(), 'labs-state'))
+
+# seconds a state or snapshot is kept after it was last written or read
+STATE_TTL = float(os.environ.get('LABS_STATE_TTL', 24 * 3600))
+# bytes of states kept, the least recently used ones are removed first
+STATE_LIMIT = int(os.environ.get('LABS_STATE_LIMIT', 2 ** 30))
+
+
+def _digest(key):
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _cleanup(directory, now):
+    """
+    Expires the states and snapshots older than STATE_TTL, then removes
+    the least recently used states until the rest fit in STATE_LIMIT.
+    The most recent state is always kept.
+    """
+    states = []
+    for path in glob.glob(os.path.join(directory, '*.npy')) + glob.glob(os.path.join(directory, '*.ckpt.npz')):
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime < now - STATE_TTL:
+                os.unlink(path)
+            elif path.endswith('.npy'):
+                states.append((stat.st_mtime, stat.st_size, path))
+        except FileNotFoundError:
+            pass
+
+    states.sort(reverse=True)
+    size = 0
+    for i, (_, state_size, path) in enumerate(states):
+        size += state_size
+        if i and size > STATE_LIMIT:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def _atomic_save(path, write):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class StateStore:
+    """
+    Last time layers of solves, stored on disk so that they outlive
+    the worker process. States are keyed by the problem and its
+    discretization and by the index of the last stored layer.
+    Every save expires old states, see _cleanup.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or STATE_DIR
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _prefix(self, key):
+        return os.path.join(self.directory, _digest(key))
+
+    def save(self, key, step, layers):
+        _atomic_save(f'{self._prefix(key)}-{step}.npy', lambda f: np.save(f, np.asarray(layers)))
+        _cleanup(self.directory, time.time())
+
+    def nearest(self, key, step):
+        """
+        Returns (stored step, layers) of the latest state not beyond step or None.
+        """
+        prefix = self._prefix(key)
+        steps = []
+        for path in glob.glob(f'{prefix}-*.npy'):
+            stored = int(path[len(prefix) + 1:-len('.npy')])
+            if stored <= step:
+                steps.append(stored)
+        if not steps:
+            return None
+        stored = max(steps)
+        path = f'{prefix}-{stored}.npy'
+        try:
+            layers = np.load(path)
+            # a state in use is recent for the cleanup
+            os.utime(path)
+        except FileNotFoundError:
+            # removed by the cleanup of another worker
+            return None
+        return stored, layers
+
+
+class Checkpointer:
+    """
+    Periodic snapshot of a running solve: the computed layers, the step
+    index and the discretization key. The snapshot file is replaced
+    atomically, so a killed worker leaves the previous one intact.
+    """
+
+    def __init__(self, key, interval=30, directory=None):
+        self.key = key
+        self.interval = interval
+        self.directory = directory or STATE_DIR
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f'{_digest(key)}.ckpt.npz')
+        self.next_save = time.monotonic() + interval
+
+    def due(self):
+        return time.monotonic() >= self.next_save
+
+    def save(self, step, layers):
+        _atomic_save(self.path, lambda f: np.savez(f, key=self.key, step=step, layers=np.asarray(layers)))
+        self.next_save = time.monotonic() + self.interval
+
+    def load(self):
+        """
+        Returns (step, layers) of the newest snapshot or None.
+        """
+        try:
+            with np.load(self.path) as snapshot:
+                if str(snapshot['key']) != self.key:
+                    return None
+                return int(snapshot['step']), snapshot['layers']
+        except FileNotFoundError:
+            return None
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
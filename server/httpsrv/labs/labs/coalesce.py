@@ -0,0 +1,107 @@
+import os
+import glob
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+COALESCE_DIR = os.environ.get('LABS_COALESCE_DIR', os.path.join(tempfile.gettempdir(), 'labs-inflight'))
+
+# seconds a finished response stays readable for the workers that waited for it
+RESULT_TTL = 60
+
+
+def request_key(data, lab_id):
+    """
+    Canonical key of a request, equal for requests with the same fields
+    regardless of their order.
+    """
+    text = json.dumps([lab_id, data], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _cleanup(directory, now):
+    """
+    Expires the responses older than RESULT_TTL. The lock file and the
+    partial response of a key are removed only when no worker solves it,
+    i.e. when its lock can be taken here.
+    """
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            if os.path.getmtime(path) < now - RESULT_TTL:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+    for path in glob.glob(os.path.join(directory, '*.lock')):
+        try:
+            if os.path.getmtime(path) >= now - RESULT_TTL:
+                continue
+            with open(path, 'a+') as lock:
+                try:
+                    fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                for tmp in glob.glob(path[:-len('.lock')] + '.*.tmp'):
+                    os.unlink(tmp)
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _copy(path, out):
+    with open(path) as f:
+        shutil.copyfileobj(f, out)
+
+
+def solve_once(key, write, out, directory=None):
+    """
+    Runs write(file) once for the concurrent workers with the same key and
+    copies the response it writes to out of each of them. The first worker
+    holds an exclusive lock while it solves, the others wait on the lock
+    and read the response file. If the first worker fails, every waiter
+    solves the request itself.
+
+    The locks are POSIX record locks: unlike flock() they are not inherited
+    by the processes the solve forks, so a killed worker never leaves its
+    lock to orphaned pool workers.
+    """
+    directory = directory or COALESCE_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, key + '.json')
+
+    with open(os.path.join(directory, key + '.lock'), 'a+') as lock:
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fcntl.lockf(lock, fcntl.LOCK_SH)
+            try:
+                _copy(path, out)
+                return
+            except FileNotFoundError:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+            write(out)
+            return
+
+        now = time.time()
+        os.utime(lock.fileno(), (now, now))
+        _cleanup(directory, now)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        # named after the key, so that cleanup leaves it alone while the lock is held
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=key + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        _copy(path, out)
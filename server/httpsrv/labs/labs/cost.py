@@ -0,0 +1,187 @@
+import math
+import os
+
+from scratch import CHUNK_ROWS
+
+# Budgets for a single request, overridable from the worker environment.
+MEMORY_BUDGET = int(os.environ.get('LABS_MEMORY_BUDGET', 512 * 2 ** 20))
+TIME_BUDGET = float(os.environ.get('LABS_TIME_BUDGET', 60))
+# 'reject' refuses requests over budget, 'downgrade' coarsens the grid until it fits
+POLICY = os.environ.get('LABS_ADMISSION', 'reject')
+# steps an adaptive solve takes at most unless the request sets max_steps
+MAX_ADAPTIVE_STEPS = int(os.environ.get('LABS_MAX_ADAPTIVE_STEPS', 10000))
+
+FLOAT_SIZES = {'float64': 8, 'float32': 4}
+# numpy array + tolist() + json text per output value
+OUTPUT_VALUE_SIZE = 64
+
+# seconds per unit of work, calibrated by benchmarks of labs.get_solution
+TIME_COEFS = {
+    5: {'implicit': 4.7e-6, 'explicit': 3.9e-6, 'crank_nicholson': 9e-7, 'theta': 9e-7},
+    6: {'implicit': 8e-7, 'explicit': 4.7e-6},
+    7: {'seidel': 7.3e-8, 'leibmann': 1.1e-7, 'decomposed': 2e-8},
+    8: {'alter_directions': 1e-7, 'fract_steps': 5e-8, 'explicit': 2e-8, 'analytic': 2e-6},
+}
+
+# grid parameters which may be coarsened on downgrade and their lower bounds
+RESOLUTION = {
+    5: {'N': 3, 'K': 2},
+    6: {'N': 3, 'K': 3},
+    7: {'N': 3},
+    8: {'N1': 3, 'N2': 3, 'K': 2},
+}
+
+
+class Estimate:
+    def __init__(self, memory, time):
+        self.memory = memory
+        self.time = time
+
+    def fits(self, memory_budget, time_budget):
+        return self.memory <= memory_budget and self.time <= time_budget
+
+
+def _time_coef(lab_id, equation_type):
+    coefs = TIME_COEFS[lab_id]
+    return coefs.get(equation_type, max(coefs.values()))
+
+
+def _float_size(data):
+    return FLOAT_SIZES.get(data.get('dtype', 'float64'), 8)
+
+
+def _estimate_1d(data, lab_id):
+    if lab_id == 5 and data.get('adaptive'):
+        return _estimate_adaptive(data)
+    N, K = int(data['N']), int(data['K'])
+    cells = N * K
+    # numerical and analytic grids, spilled grids are memory-mapped
+    # and streamed a chunk of rows at a time
+    memory = 2 * (N * min(K, CHUNK_ROWS) if data.get('spill') else cells) * OUTPUT_VALUE_SIZE
+    if data.get('richardson'):
+        # the second grid halves h and refines tau by 2 (lab6) or up to 4 (lab5)
+        fine_cells = cells * (2 if lab_id == 6 else 4) * 2
+        memory += (cells + fine_cells) * _float_size(data)
+        cells += fine_cells
+    time = _time_coef(lab_id, data['equation_type']) * cells
+    if data.get('parareal'):
+        # every iteration refines a slice per worker at a time
+        options = data['parareal'] if isinstance(data['parareal'], dict) else {}
+        slices = int(options.get('slices', os.cpu_count()))
+        workers = min(int(options.get('workers') or os.cpu_count()), os.cpu_count(), slices)
+        iterations = int(options.get('iterations', slices))
+        time *= iterations / slices * math.ceil(slices / workers)
+        # the fine slices and the assembled solution, and a slice being solved per worker
+        memory += (2 * K + workers * (math.ceil(K / slices) + 3)) * N * _float_size(data)
+    return Estimate(memory, time)
+
+
+def _estimate_adaptive(data):
+    # the step count depends on the tolerances only, so the estimate takes the cap
+    N, steps = int(data['N']), int(data.get('max_steps', MAX_ADAPTIVE_STEPS))
+    cells = N * (steps + 1)
+    # in-memory layers, numerical and analytic output
+    memory = cells * (_float_size(data) + 2 * OUTPUT_VALUE_SIZE)
+    # a step and two half steps per accepted step
+    time = _time_coef(5, 'theta') * 3 * cells
+    return Estimate(memory, time)
+
+
+def _estimate_lab7(data):
+    N, eps = int(data['N']), float(data['eps'])
+    n = (N - 1) ** 2
+    # the solver forks no more workers than there are cores
+    workers = min(int(data.get('workers', 1)), os.cpu_count())
+    if workers > 1:
+        return _estimate_lab7_decomposed(data, N, n, eps, workers)
+    # A and alpha are dense n x n, seidel also splits alpha into E, B, C
+    matrices = 5 if data['equation_type'] == 'seidel' else 2
+    memory = matrices * n * n * _float_size(data) + 2 * N * N * OUTPUT_VALUE_SIZE
+    # every sweep is O(n^2), simple iteration needs O(N^2 ln(1/eps)) sweeps
+    iterations = N * N * max(1.0, -math.log(eps))
+    time = _time_coef(7, data['equation_type']) * n * n * iterations
+    return Estimate(memory, time)
+
+
+def _estimate_lab7_decomposed(data, N, n, eps, workers):
+    # weights, beta, two shared buffers and a strip copy per worker, no dense matrices
+    memory = 8 * n * _float_size(data) + 2 * N * N * OUTPUT_VALUE_SIZE
+    sweeps = int(data.get('sweeps', 4))
+    iterations = min(N * N * max(1.0, -math.log(eps)) / sweeps, int(data.get('max_iterations', 10000)))
+    time = _time_coef(7, 'decomposed') * n * sweeps * iterations / workers
+    return Estimate(memory, time)
+
+
+def _estimate_lab8(data):
+    N1, N2, K = int(data['N1']), int(data['N2']), int(data['K'])
+    layer = N1 * N2
+    memory = (layer + K * (N1 + N2)) * OUTPUT_VALUE_SIZE
+    if data['equation_type'] == 'explicit':
+        # the explicit scheme steps K times and keeps the current and the middle layer
+        memory += 2 * layer * _float_size(data)
+        steps = K
+    else:
+        # ADI methods keep three working layers and the returned one
+        memory += 4 * layer * _float_size(data)
+        steps = N1
+        # the line solves of the half-steps are split across the workers
+        steps /= min(int(data.get('workers', 1)), os.cpu_count())
+    time = _time_coef(8, 'analytic') * (K * (N1 + N2) + layer) + \
+        _time_coef(8, data['equation_type']) * steps * layer
+    return Estimate(memory, time)
+
+
+def estimate(data, lab_id):
+    if lab_id in (5, 6):
+        return _estimate_1d(data, lab_id)
+    elif lab_id == 7:
+        return _estimate_lab7(data)
+    elif lab_id == 8:
+        return _estimate_lab8(data)
+    raise Exception(f"Unknown lab {lab_id}")
+
+
+def _downgrade(data, lab_id, memory_budget, time_budget):
+    data = dict(data)
+    bounds = RESOLUTION[lab_id]
+    while not estimate(data, lab_id).fits(memory_budget, time_budget):
+        coarsened = False
+        for key, lower in bounds.items():
+            value = int(data[key])
+            if value > lower:
+                data[key] = max(lower, int(value * 0.9))
+                coarsened = True
+        if not coarsened:
+            return None
+    return data
+
+
+def admit(data, lab_id, memory_budget=None, time_budget=None, policy=None):
+    """
+    Pre-flight check of a request against the worker budgets.
+
+    Returns the request to run (possibly with a coarser grid when the policy
+    is 'downgrade') and a description of the decision.
+    Raises if the request does not fit the budgets.
+    """
+    memory_budget = MEMORY_BUDGET if memory_budget is None else memory_budget
+    time_budget = TIME_BUDGET if time_budget is None else time_budget
+    policy = POLICY if policy is None else policy
+
+    cost = estimate(data, lab_id)
+    if cost.fits(memory_budget, time_budget):
+        return data, None
+
+    if policy == 'downgrade':
+        downgraded = _downgrade(data, lab_id, memory_budget, time_budget)
+        if downgraded is not None:
+            return downgraded, {
+                'downgraded': True,
+                'requested': {key: int(data[key]) for key in RESOLUTION[lab_id]},
+                'granted': {key: int(downgraded[key]) for key in RESOLUTION[lab_id]},
+            }
+
+    raise Exception(
+        f"Request is over budget: estimated {cost.memory / 2 ** 20:.1f} MiB "
+        f"and {cost.time:.1f} s, allowed {memory_budget / 2 ** 20:.1f} MiB "
+        f"and {time_budget:.1f} s")
@@ -0,0 +1,16 @@
+import time
+
+
+class Deadline:
+    """
+    Wall-clock time budget of a request.
+
+    Solvers check it between time steps or iterations and stop early
+    with the part of the solution computed so far.
+    """
+
+    def __init__(self, budget=None):
+        self.expires = None if budget is None else time.monotonic() + budget
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
@@ -0,0 +1,92 @@
+import multiprocessing
+
+import numpy as np
+
+from forkpool import ForkPool, shared
+
+TYPECODES = {np.dtype(np.float64): 'd', np.dtype(np.float32): 'f'}
+
+
+def stencil(x, beta, weights):
+    """
+    beta + alpha x for alpha given by the weights of the north, south,
+    west and east neighbours of every point, neighbours outside x count as 0.
+    """
+    y = np.array(beta, dtype=np.result_type(x, beta))
+    y[1:] += weights[0][1:] * x[:-1]
+    y[:-1] += weights[1][:-1] * x[1:]
+    y[:, 1:] += weights[2][:, 1:] * x[:, :-1]
+    y[:, :-1] += weights[3][:, :-1] * x[:, 1:]
+    return y
+
+
+def _relax(start, stop, src, dst):
+    """
+    Local sweeps on the rows [start, stop) with the halo rows of the
+    previous outer iteration kept fixed.
+    """
+    domain = shared()
+    lo, hi = max(start - 1, 0), min(stop + 1, len(domain.beta))
+    x = np.array(domain.buffers[src][lo:hi])
+    beta, weights = domain.beta[lo:hi], domain.weights[:, lo:hi]
+    own = slice(start - lo, stop - lo)
+
+    for _ in range(domain.sweeps):
+        if domain.red_black:
+            for colour in domain.colours[:, lo:hi]:
+                x[own] = np.where(colour[own], stencil(x, beta, weights)[own], x[own])
+        else:
+            x[own] = stencil(x, beta, weights)[own]
+
+    domain.buffers[dst][start:stop] = x[own]
+
+
+class Decomposition:
+    """
+    Block Jacobi iteration of x = beta + alpha x on a grid split into strips
+    of rows, one per worker process. Every outer iteration each worker runs
+    local Jacobi (or red-black Gauss-Seidel) sweeps on its strip and the
+    strips exchange halo rows through two shared buffers.
+    """
+
+    def __init__(self, weights, beta, x0, workers, sweeps=4, red_black=False):
+        self.weights = weights
+        self.beta = beta
+        self.sweeps = sweeps
+        self.red_black = red_black
+        rows, cols = beta.shape
+        if red_black:
+            parity = (np.arange(rows)[:, np.newaxis] + np.arange(cols)[np.newaxis, :]) % 2
+            self.colours = np.stack([parity == 0, parity == 1])
+
+        typecode = TYPECODES[beta.dtype]
+        self.buffers = [
+            np.frombuffer(multiprocessing.RawArray(typecode, rows * cols), dtype=beta.dtype).reshape(rows, cols)
+            for _ in range(2)
+        ]
+        self.buffers[0][:] = x0
+        self.current = 0
+
+        bounds = np.linspace(0, rows, min(workers, rows) + 1).astype(int)
+        self.strips = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        self.workers = workers
+        self.pool = None
+
+    def __enter__(self):
+        self.pool = ForkPool(self, len(self.strips) if self.workers > 1 else 0).__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.__exit__(*exc)
+        self.pool = None
+
+    def iterate(self):
+        """
+        Runs one outer iteration, returns the new x and its update.
+        """
+        src, dst = self.current, 1 - self.current
+        count = len(self.strips)
+        starts, stops = zip(*self.strips)
+        self.pool.map(_relax, starts, stops, [src] * count, [dst] * count)
+        self.current = dst
+        return self.buffers[dst], self.buffers[dst] - self.buffers[src]
@@ -0,0 +1,77 @@
+import ast
+import functools
+
+import numpy as np
+
+# names an expression may use besides its variables
+FUNCTIONS = {
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'arcsin': np.arcsin, 'arccos': np.arccos, 'arctan': np.arctan,
+    'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+    'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt, 'abs': np.abs,
+}
+CONSTANTS = {'pi': np.pi, 'e': np.e}
+
+OPERATORS = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.UAdd, ast.USub,
+)
+
+
+def _check(tree, variables):
+    for node in ast.walk(tree):
+        if not isinstance(node, OPERATORS):
+            raise Exception(f"Unsupported syntax in expression: {type(node).__name__}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise Exception(f"Unsupported constant in expression: {node.value!r}")
+        if isinstance(node, ast.Constant):
+            # float arithmetic only, integer powers like 9 ** 9 ** 9 never finish
+            node.value = float(node.value)
+        if isinstance(node, ast.Name) and node.id not in variables and \
+                node.id not in FUNCTIONS and node.id not in CONSTANTS:
+            raise Exception(f"Unknown name in expression: {node.id}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise Exception("Only calls of math functions are allowed in expressions")
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expression(text, variables):
+    """
+    Compiles a math expression of the given variables, e.g. 'exp(-t) * sin(x)'
+    of ('x', 't'), into a function of numpy arrays. The result is broadcast
+    to the shape of the arguments, so constant expressions work on grids too.
+    """
+    try:
+        tree = ast.parse(text, mode='eval')
+    except SyntaxError:
+        raise Exception(f"Invalid expression: {text}")
+    _check(tree, variables)
+    code = compile(tree, '<expression>', 'eval')
+    namespace = {'__builtins__': {}, **FUNCTIONS, **CONSTANTS}
+
+    def func(*args):
+        value = eval(code, namespace, dict(zip(variables, args)))
+        shape = np.broadcast(*args).shape if args else ()
+        if not shape:
+            return float(value)
+        return np.broadcast_to(value, shape).astype(float)
+
+    return func
+
+
+def compile_problem(problem, signatures, params):
+    """
+    Replaces the problem functions and constants of params by the ones of
+    a request, {name: expression or number}. signatures maps the name of
+    every function to its variables.
+    """
+    params = dict(params)
+    for name, value in problem.items():
+        if name in signatures:
+            params[name] = compile_expression(str(value), signatures[name])
+        elif isinstance(params.get(name), (int, float)) and isinstance(value, (int, float)):
+            params[name] = value
+        else:
+            raise Exception(f"Unknown problem parameter {name}")
+    return params
@@ -0,0 +1,91 @@
+import os
+import time
+import ctypes
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# object of the running parallel computation, the forked workers inherit it
+_shared = None
+
+PR_SET_PDEATHSIG = 1
+
+
+def _watch_parent(parent):
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(1)
+
+
+def die_with_parent(parent):
+    """
+    Initializer of pool workers: a worker whose parent is killed would wait
+    on the call queue forever, so it is killed with the parent (on Linux)
+    or exits once it notices the parent is gone.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL) != 0:
+            raise OSError(ctypes.get_errno(), 'prctl failed')
+    except (OSError, AttributeError):
+        threading.Thread(target=_watch_parent, args=(parent,), daemon=True).start()
+    # the parent may have died before the signal was set up
+    if os.getppid() != parent:
+        os._exit(1)
+
+
+def shared():
+    """
+    The object of the innermost ForkPool, for the task functions.
+    """
+    return _shared
+
+
+class ForkPool:
+    """
+    Process pool of workers forked from this process, so that the task
+    functions reach obj through shared() instead of pickling it.
+    With workers = 0 or without fork the tasks run in this process,
+    workers = None means all cores.
+    """
+
+    def __init__(self, obj, workers=None):
+        self.obj = obj
+        self.workers = workers
+        self.pool = None
+
+    def __enter__(self):
+        global _shared
+        self.previous, _shared = _shared, self.obj
+        if self.workers != 0:
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:
+                context = None
+            if context is not None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                initializer=die_with_parent, initargs=(os.getpid(),))
+        return self
+
+    def __exit__(self, *exc):
+        global _shared
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        _shared = self.previous
+
+    def submit(self, func, *args):
+        if self.pool is not None:
+            return self.pool.submit(func, *args)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def map(self, func, *iterables):
+        if self.pool is not None:
+            return list(self.pool.map(func, *iterables))
+        return list(map(func, *iterables))
@@ -1,6 +1,13 @@
+import copy
+
 import numpy as np
 
-from utils import tma
+from utils import tma, tma_factor, tma_solve
+from deadline import Deadline
+from progress import Progress
+from richardson import extrapolate
+from parareal import integrate
+from scratch import zeros, CHUNK_ROWS
 
 
 class EquationData:
@@ -12,29 +19,116 @@ class EquationData:
         self.phil = params['phil']
         self.bound_type = params['bound_type']
         self.solution = params['solution']
+        self.theta = params.get('theta', 0.5)
+        self.dtype = params.get('dtype', np.float64)
+        self.scratch = params.get('scratch')
 
 
 class ParabolicSolver:
+    # problem functions with time as the last argument
+    time_functions = ('f', 'phi0', 'phil')
+
     def __init__(self, params, equation_type):
         self.data = EquationData(params)
+        self.equation_type = equation_type
         try:
             self.solve_func = getattr(self, f'_{equation_type}_solve')
         except:
             raise Exception("This type does not exist")
 
-    def solve(self, N, K, T):
+    def solve(self, N, K, T, deadline=None, reporter=None, store=None, state_key=None, richardson=False,
+              adaptive=None, parareal=None):
+        if richardson:
+            return self._richardson_solve(N, K, T, deadline)
+        self._setup(N, T / K, deadline, reporter)
+        self.progress = {'step': K, 'steps': K}
+        self.store = store
+        self.state_key = state_key
+        self.first_step = 0
+        self.times = None
+        if adaptive is not None:
+            return self._adaptive_solve(N, T, adaptive['atol'], adaptive['rtol'], adaptive['max_steps'])
+        if parareal is not None:
+            return self._parareal_solve(N, K, parareal)
+        u = self.solve_func(N, K, T)
+        if store is not None and len(u) > self.first_step:
+            store.save(state_key, len(u) - 1, u[-1:])
+        return u
+
+    def _setup(self, N, tau, deadline=None, reporter=None):
         self.h = self.data.l / N
-        self.tau = T / K
+        self.tau = tau
         self.sigma = self.tau / (self.h ** 2)
-        return self.solve_func(N, K, T)
+        self.deadline = deadline or Deadline()
+        self.reporter = reporter or Progress()
+        self.truncated = False
 
-    def solve_analytic(self, N, K, T):
+    def _parareal_solve(self, N, K, options):
+        """
+        Parareal over time slices with the implicit scheme on a coarser
+        time grid as the coarse propagator and this scheme as the fine one.
+        """
+        coarsening = options['coarsening']
+        coarse = copy.copy(self)
+        coarse.solve_func = coarse._implicit_solve
+        coarse._setup(N, coarsening * self.tau)
+        deadline, reporter = self.deadline, self.reporter
+        u, self.parareal = integrate(self, coarse, N, K, 1, coarsening, options['slices'], options['tol'],
+                                     options['iterations'], deadline, reporter, options['workers'])
+        self.deadline, self.reporter = deadline, reporter
+        if len(u) < K or not self.parareal['converged'] and deadline.expired():
+            self.truncated = True
+            self.progress = {'step': len(u), 'steps': K}
+        return u
+
+    def _richardson_refinement(self):
+        """
+        Time refinement and drop of the leading error term when h is halved:
+        O(tau^2 + h^2) for Crank-Nicolson, O(tau + h^2) otherwise.
+        """
+        if self.equation_type in ('crank_nicholson', 'theta') and self.data.theta == 0.5:
+            return 2, 4
+        return 4, 4
+
+    def _richardson_solve(self, N, K, T, deadline):
+        time_factor, ratio = self._richardson_refinement()
+        u, self.error_estimate, truncated = extrapolate(self, N, K, T, time_factor, ratio, deadline)
+        self.truncated = truncated
+        self.progress = {'step': len(u), 'steps': K}
+        return u
+
+    def _resume(self, u, first, K):
+        """
+        Restores the latest stored layers of this problem not beyond K,
+        returns the step to continue from.
+        """
+        if self.store is None:
+            return first
+        state = self.store.nearest(self.state_key, K - 1)
+        if state is None or state[0] < first:
+            return first
+        step, layers = state
+        u[step - len(layers) + 1:step + 1] = layers
+        # a state at the last step is returned as the only new layer
+        self.first_step = min(step + 1, K - 1)
+        return step + 1
+
+    def _truncate(self, u, k, K):
+        self.truncated = True
+        self.progress = {'step': k, 'steps': K}
+        return u[:k]
+
+    def solve_analytic(self, N, K, T, times=None):
         self.h = self.data.l / N
         self.tau = T / K
-        u = np.zeros((K, N))
-        for k in range(K):
-            for j in range(N):
-                u[k][j] = self.data.solution(j * self.h, k * self.tau)
+        if times is None:
+            times = [k * self.tau for k in range(K)]
+        times = np.asarray(times, dtype=float)
+        x = np.arange(N) * self.h
+        u = zeros((len(times), N), self.data.dtype, self.data.scratch)
+        for start in range(0, len(times), CHUNK_ROWS):
+            t = times[start:start + CHUNK_ROWS]
+            u[start:start + CHUNK_ROWS] = self.data.solution(x[np.newaxis, :], t[:, np.newaxis])
         return u
 
     def _implicit_solve(self, N, K, T):
@@ -42,13 +136,16 @@ class ParabolicSolver:
         b = np.zeros(N)
         c = np.zeros(N)
         d = np.zeros(N)
-        u = np.zeros((K, N))
+        u = zeros((K, N), self.data.dtype, self.data.scratch)
 
         for i in range(1, N - 1):
             u[0][i] = self.data.psi(i * self.h)
         u[0][-1] = 0
 
-        for k in range(1, K):
+        for k in range(self._resume(u, 1, K), K):
+            if self.deadline.expired():
+                return self._truncate(u, k, K)
+            self.reporter.report(step=k, steps=K)
             for j in range(1, N - 1):
                 a[j] = self.sigma
                 b[j] = -(1 + 2 * self.sigma)
@@ -88,11 +185,14 @@ class ParabolicSolver:
         return u
 
     def _explicit_solve(self, N, K, T):
-        u = np.zeros((K, N))
+        u = zeros((K, N), self.data.dtype, self.data.scratch)
         for j in range(1, N - 1):
             u[0][j] = self.data.psi(j * self.h)
 
-        for k in range(1, K):
+        for k in range(self._resume(u, 1, K), K):
+            if self.deadline.expired():
+                return self._truncate(u, k, K)
+            self.reporter.report(step=k, steps=K)
             u[k][0] = self.data.phi0(k * self.tau)
             for j in range(1, N - 1):
                 u[k][j] = self.sigma * u[k - 1][j + 1] + \
@@ -110,62 +210,122 @@ class ParabolicSolver:
         return u
 
     def _crank_nicholson_solve(self, N, K, T):
-        theta = 0.5
-        a = np.zeros(N)
-        b = np.zeros(N)
-        c = np.zeros(N)
-        d = np.zeros(N)
-        tmp_imp = np.zeros(N)
-        u = np.zeros((K, N))
-        for j in range(1, N - 1):
-            u[0][j] = self.data.psi(j * self.h)
+        return self._theta_solve(N, K, T)
 
-        for k in range(1, K):
-            for j in range(1, N - 1):
-                a[j] = self.sigma
-                b[j] = -(1 + 2 * self.sigma)
-                c[j] = self.sigma
-                d[j] = -u[k - 1][j] - self.tau * self.data.f(j * self.h, k * self.tau)
+    def _theta_solve(self, N, K, T):
+        """
+        Weighted scheme: theta = 1 is the implicit scheme, theta = 0.5 is Crank-Nicolson.
+        One tridiagonal system per step, the explicit part goes to the right-hand side.
+        """
+        theta = self.data.theta
+        x = np.arange(N) * self.h
+        factors = self._theta_system(N, theta, self.tau)
 
-            if self.data.bound_type == 'a1p1':
-                a[0] = 0
-                b[0] = -(1 + 2 * self.sigma)
-                c[0] = self.sigma
-                d[0] = -(u[k - 1][0] + self.sigma * self.data.phi0(k * self.tau))
-                a[-1] = self.sigma
-                b[-1] = -(1 + 2 * self.sigma)
-                c[-1] = 0
-                d[-1] = -(u[k - 1][-1] + self.sigma * self.data.phil(k * self.tau))
-            elif self.data.bound_type == 'a1p2':
-                a[0] = 0
-                b[0] = -(1 + 2 * self.sigma)
-                c[0] = self.sigma
-                d[0] = -(u[k - 1][0] + self.sigma * self.data.phi0(k * self.tau)) - self.tau * self.data.f(0, k * self.tau)
-                a[-1] = self.sigma
-                b[-1] = -(1 + 2 * self.sigma)
-                c[-1] = 0
-                d[-1] = -(u[k - 1][-1] + self.sigma * self.data.phil(k * self.tau)) - self.tau * self.data.f((N - 1) * self.h, k * self.tau)
-            elif self.data.bound_type == 'a1p3':
-                a[0] = 0
-                b[0] = -(1 + 2 * self.sigma)
-                c[0] = self.sigma
-                d[0] = -((1 - self.sigma) * u[k - 1][1] + self.sigma / 2 * u[k - 1][0]) - self.tau * f(0, k * self.tau) - self.sigma * self.data.phi0(k * self.tau)
-                a[-1] = self.sigma
-                b[-1] = -(1 + 2 * self.sigma)
-                c[-1] = 0
-                d[-1] = self.data.phil(k * self.tau) + self.data.f((N - 1) * self.h, k * self.tau) * self.h / (2 * self.tau) * u[k - 1][-1]
+        u = zeros((K, N), self.data.dtype, self.data.scratch)
+        u[0][1:-1] = self.data.psi(x[1:-1])
+        first = self._resume(u, 1, K)
+        f_prev = self.data.f(x, (first - 1) * self.tau)
 
-            tmp_imp = tma(a, b, c, d)
+        for k in range(first, K):
+            if self.deadline.expired():
+                return self._truncate(u, k, K)
+            self.reporter.report(step=k, steps=K)
 
-            tmp_exp = np.zeros(N)
-            tmp_exp[0] = self.data.phi0(self.tau)
-            for j in range(1, N - 1):
-                tmp_exp[j] = self.sigma * u[k - 1][j + 1] + \
-                            (1 - 2 * self.sigma) * u[k - 1][j] + \
-                            self.sigma * u[k - 1][j - 1] + self.tau * self.data.f(j * self.h, k * self.tau)
-            tmp_exp[-1] = self.data.phil(self.tau)
-
-            for j in range(N):
-                u[k][j] = theta * tmp_imp[j] + (1 - theta) * tmp_exp[j]
+            u[k], f_prev = self._theta_step(factors, theta, self.tau, u[k - 1], (k - 1) * self.tau, k * self.tau, f_prev, x)
 
         return u
+
+    def _theta_system(self, N, theta, tau):
+        if self.data.bound_type not in ('a1p1', 'a1p2'):
+            raise Exception(f"Bound type {self.data.bound_type} is not supported by theta scheme")
+
+        implicit = theta * tau / (self.h ** 2)
+        a = np.full(N, implicit)
+        b = np.full(N, -(1 + 2 * implicit))
+        c = np.full(N, implicit)
+        a[0] = 0
+        c[-1] = 0
+        return tma_factor(a, b, c, self.data.dtype)
+
+    def _theta_step(self, factors, theta, tau, prev, t_prev, t, f_prev, x):
+        """
+        One step of the weighted scheme from t_prev to t, returns the new layer and f at t.
+        """
+        sigma = tau / (self.h ** 2)
+        implicit = theta * sigma
+        explicit = (1 - theta) * sigma
+
+        lap = np.empty(len(prev))
+        lap[1:-1] = prev[:-2] - 2 * prev[1:-1] + prev[2:]
+        lap[0] = self.data.phi0(t_prev) - 2 * prev[0] + prev[1]
+        lap[-1] = prev[-2] - 2 * prev[-1] + self.data.phil(t_prev)
+
+        f_cur = self.data.f(x, t)
+        d = -(prev + explicit * lap) - tau * (theta * f_cur + (1 - theta) * f_prev)
+        if self.data.bound_type == 'a1p1':
+            d[0] = -(prev[0] + explicit * lap[0])
+            d[-1] = -(prev[-1] + explicit * lap[-1])
+        d[0] -= implicit * self.data.phi0(t)
+        d[-1] -= implicit * self.data.phil(t)
+
+        return tma_solve(factors, d), f_cur
+
+    def _adaptive_solve(self, N, T, atol, rtol, max_steps):
+        """
+        Implicit or weighted scheme with the step chosen by step doubling:
+        a step of tau is compared to two steps of tau / 2 and the step is
+        halved until the local error estimate meets atol + rtol * |u|.
+        Steps are powers of two of the initial T / K, so every step size
+        factors its system once (the last step may be shortened to end at T).
+        The solution is truncated after max_steps steps.
+        """
+        if self.equation_type == 'implicit':
+            theta = 1
+        elif self.equation_type in ('crank_nicholson', 'theta'):
+            theta = self.data.theta
+        else:
+            raise Exception(f"Adaptive steps are not supported by {self.equation_type} scheme")
+        order = 2 if theta == 0.5 else 1
+        min_tau = T * 1e-9
+
+        systems = {}
+
+        def step(tau, prev, t_prev, f_prev):
+            if tau not in systems:
+                systems[tau] = self._theta_system(N, theta, tau)
+            return self._theta_step(systems[tau], theta, tau, prev, t_prev, t_prev + tau, f_prev, x)
+
+        x = np.arange(N) * self.h
+        u = np.zeros(N)
+        u[1:-1] = self.data.psi(x[1:-1])
+        layers, times = [u], [0.0]
+        f_prev = self.data.f(x, 0.0)
+        t, tau = 0.0, self.tau
+
+        while T - t > min_tau:
+            if self.deadline.expired() or len(layers) > max_steps:
+                self.truncated = True
+                break
+            self.reporter.report(step=len(layers), time=t, T=T)
+
+            tau = min(tau, T - t)
+            prev = layers[-1]
+            full, _ = step(tau, prev, t, f_prev)
+            mid, f_mid = step(tau / 2, prev, t, f_prev)
+            fine, f_cur = step(tau / 2, mid, t + tau / 2, f_mid)
+
+            error = np.max(np.abs(fine - full) / (atol + rtol * np.abs(fine))) / (2 ** order - 1)
+            if error > 1 and tau > min_tau:
+                tau /= 2
+                continue
+
+            t += tau
+            layers.append(fine)
+            times.append(t)
+            f_prev = f_cur
+            if error < 2 ** -(order + 1):
+                tau *= 2
+
+        self.times = times
+        self.progress = {'step': len(layers), 'time': t, 'T': T}
+        return np.array(layers, dtype=self.data.dtype)
@@ -1,6 +1,13 @@
+import copy
+
 import numpy as np
 
-from utils import tma
+from utils import tma_factor, tma_solve
+from deadline import Deadline
+from progress import Progress
+from richardson import extrapolate
+from parareal import integrate
+from scratch import zeros, CHUNK_ROWS
 
 
 class EquationData:
@@ -24,34 +31,128 @@ class EquationData:
         self.bound_type = params['bound_type']
         self.approximation = params['approximation']
         self.solution = params['solution']
+        self.dtype = params.get('dtype', np.float64)
+        self.scratch = params.get('scratch')
 
 
 class HyperbolicSolver:
+    # problem functions with time as the last argument
+    time_functions = ('phi0', 'phil')
+
     def __init__(self, params, equation_type):
         self.data = EquationData(params)
+        self.equation_type = equation_type
         try:
             self.solve_func = getattr(self, f'_{equation_type}_solve')
         except:
             raise Exception("This type does not exist")
 
-    def solve(self, N, K, T):
-        self.h = self.data.l / N;
-        self.tau = T / K;
+    def solve(self, N, K, T, deadline=None, reporter=None, store=None, state_key=None, checkpointer=None,
+              richardson=False, parareal=None):
+        if richardson:
+            return self._richardson_solve(N, K, T, deadline)
+        self._setup(N, T / K, deadline, reporter)
+        self.progress = {'step': K, 'steps': K}
+        self.store = store
+        self.state_key = state_key
+        self.first_step = 0
+        if parareal is not None:
+            return self._parareal_solve(N, K, parareal)
+        self.checkpointer = checkpointer
+        u = self.solve_func(N, K, T)
+        if checkpointer is not None:
+            if self.truncated:
+                checkpointer.save(len(u) - 1, u)
+            else:
+                checkpointer.clear()
+        if store is not None and len(u) > self.first_step:
+            store.save(state_key, len(u) - 1, u[-2:])
+        return u
+
+    def _setup(self, N, tau, deadline=None, reporter=None):
+        self.h = self.data.l / N
+        self.tau = tau
         self.sigma = (self.tau ** 2) / (self.h ** 2)
-        return self.solve_func(N, K, T)
+        self.deadline = deadline or Deadline()
+        self.reporter = reporter or Progress()
+        self.truncated = False
+        self.checkpointer = None
+
+    def _parareal_solve(self, N, K, options):
+        """
+        Parareal over time slices with the implicit scheme on a coarser
+        time grid as the coarse propagator and this scheme as the fine one.
+        States are the last two layers, the coarse grid gets the earlier
+        one extrapolated linearly.
+        """
+        coarsening = options['coarsening']
+        coarse = copy.copy(self)
+        coarse.solve_func = coarse._implicit_solve
+        coarse._setup(N, coarsening * self.tau)
+        deadline, reporter = self.deadline, self.reporter
+        u, self.parareal = integrate(self, coarse, N, K, 2, coarsening, options['slices'], options['tol'],
+                                     options['iterations'], deadline, reporter, options['workers'])
+        self.deadline, self.reporter = deadline, reporter
+        if len(u) < K or not self.parareal['converged'] and deadline.expired():
+            self.truncated = True
+            self.progress = {'step': len(u), 'steps': K}
+        return u
+
+    def _richardson_refinement(self):
+        """
+        Time refinement and drop of the leading error term when h is halved,
+        both schemes are O(tau^2 + h^2).
+        """
+        return 2, 4
+
+    def _richardson_solve(self, N, K, T, deadline):
+        time_factor, ratio = self._richardson_refinement()
+        u, self.error_estimate, truncated = extrapolate(self, N, K, T, time_factor, ratio, deadline)
+        self.truncated = truncated
+        self.progress = {'step': len(u), 'steps': K}
+        return u
+
+    def _resume(self, u, first, K):
+        """
+        Restores the layers of an interrupted run of this request or
+        the latest stored layers of this problem not beyond K,
+        returns the step to continue from.
+        """
+        if self.checkpointer is not None:
+            snapshot = self.checkpointer.load()
+            if snapshot is not None and snapshot[0] >= first:
+                step, layers = snapshot
+                u[:step + 1] = layers
+                return step + 1
+        if self.store is None:
+            return first
+        state = self.store.nearest(self.state_key, K - 1)
+        if state is None or state[0] < first:
+            return first
+        step, layers = state
+        u[step - len(layers) + 1:step + 1] = layers
+        # a state at the last step is returned as the only new layer
+        self.first_step = min(step + 1, K - 1)
+        return step + 1
+
+    def _truncate(self, u, k, K):
+        self.truncated = True
+        self.progress = {'step': k, 'steps': K}
+        return u[:k]
 
     def solve_analytic(self, N, K, T):
         self.h = self.data.l / N;
         self.tau = T / K;
         self.sigma = (self.tau ** 2) / (self.h ** 2)
-        u = np.zeros((K, N))
-        for k in range(K):
-            for j in range(N):
-                u[k][j] = self.data.solution(j * self.h, k * self.tau)
+        x = np.arange(N) * self.h
+        u = zeros((K, N), self.data.dtype, self.data.scratch)
+        for start in range(0, K, CHUNK_ROWS):
+            t = np.arange(start, min(start + CHUNK_ROWS, K)) * self.tau
+            u[start:start + CHUNK_ROWS] = self.data.solution(x[np.newaxis, :], t[:, np.newaxis])
         return u
 
     def _implicit_solve(self, N, K, T):
-        u = np.zeros((K, N))
+        u = zeros((K, N), self.data.dtype, self.data.scratch)
 
         for j in range(N):
             x = j * self.h
@@ -67,52 +168,83 @@ class HyperbolicSolver:
                     (self.tau - self.data.d * k) * self.data.psi1(x) + \
                     k * self.data.f()
 
-        a = np.zeros(N)
-        b = np.zeros(N)
-        c = np.zeros(N)
+        a = np.full(N, self.sigma)
+        b = np.full(N, -(1 + 2 * self.sigma))
+        c = np.full(N, self.sigma)
+        a[0] = 0
+        c[-1] = 0
+        bound_rhs = self._implicit_bounds(a, b, c)
+        factors = tma_factor(a, b, c, self.data.dtype)
         d = np.zeros(N)
 
-        for k in range(2, K):
-            for j in range(1, N - 1):
-                a[j] = self.sigma
-                b[j] = -(1 + 2 * self.sigma)
-                c[j] = self.sigma
-                d[j] = -2 * u[k - 1][j] + u[k - 2][j]
-
-            if self.data.bound_type == 'a1p2':
-                b[0] = self.data.alpha / self.h / (self.data.beta - self.data.alpha / self.h)
-                c[0] = 1
-                d[0] = 1 / (self.data.beta - self.data.alpha / self.h) * self.data.phi0(k * self.tau)
-                a[-1] = -self.data.gamma / self.h / (self.data.delta + self.data.gamma / self.h)
-                d[-1] = 1 / (self.data.delta + self.data.gamma / self.h) * self.data.phil(k * self.tau)
-            elif self.data.bound_type == 'a2p3':
-                k1 = 2 * self.h * self.data.beta - 3 * self.data.alpha
-                k2 = 2 * self.h * self.data.delt + 3 * self.data.gamma
-                omega = self.tau ** 2 * self.data.b / (2 * self.h)
-                xi = self.data.d * self.tau / 2
-
-                b[0] = 4 * self.data.alpha - self.data.alpha / (self.sigma + omega) * (1 + xi + 2 * self.sigma - self.data.c * self.tau ** 2)
-                c[0] = k1 - self.data.alpha * (omega - self.sigma) / (omega + self.sigma)
-                d[0] = 2 * self.h * self.data.phi0(k * self.tau) + self.data.alpha * d[1] / (-sigma - omega)
-                a[-1] = -self.data.gamma / (omega - sel.sigma) * (1 + xi + 2 * self.sigma - self.data.c * self.tau ** 2) - 4 * self.data.gamma
-                d[-1] = 2 * self.h * self.data.phil(k * self.tau) - self.data.gamma * d[-2] / (omega - self.sigma)
-            elif self.data.bound_type == 'a2p2':
-                b[0] = 2 * self.data.a / self.h
-                c[0] = -2 * self.data.a / self.h + self.h / self.tau ** 2 - self.data.c * self.h + \
-                    -self.data.d * self.h / (2 * self.tau) + \
-                    self.data.beta / self.data.alpha * (2 * self.data.a + self.data.b * self.h)
-                d[0] = self.h / self.tau ** 2 * (u[k - 2][0] - 2 * u[k - 1][0]) - self.h * self.data.f() + \
-                    -self.data.d * self.h / (2 * self.tau) * u[k - 2][0] + \
-                    (2 * self.data.a - self.data.b * self.h) / self.data.alpha * self.data.phi0(k * self.tau)
-                a[-1] =-b[0]
-                d[-1] = self.h / self.tau ** 2 * (-u[k - 2][0] + 2 * u[k - 1][0]) + self.h * self.data.f() + \
-                    self.data.d * self.h / (2 * self.tau) * u[k - 2][0] + \
-                    (2 * self.data.a + self.data.b * self.h) / self.data.alpha * self.data.phil(k * self.tau)
-
-            u[k] = tma(a, b, c, d)
+        for k in range(self._resume(u, 2, K), K):
+            if self.deadline.expired():
+                return self._truncate(u, k, K)
+            self.reporter.report(step=k, steps=K)
+            if self.checkpointer is not None and self.checkpointer.due():
+                self.checkpointer.save(k - 1, u[:k])
+            d[:] = u[k - 2]
+            d -= 2 * u[k - 1]
+            bound_rhs(u, k, d)
+
+            u[k] = tma_solve(factors, d)
 
         return u
 
+    def _implicit_bounds(self, a, b, c):
+        """
+        Sets the boundary rows of the implicit scheme matrix, they do not change
+        between steps, and returns the function setting the boundary entries of
+        the right-hand side d of step k.
+        """
+        data = self.data
+        if data.bound_type == 'a1p2':
+            left = data.beta - data.alpha / self.h
+            right = data.delta + data.gamma / self.h
+            b[0] = data.alpha / self.h / left
+            c[0] = 1
+            a[-1] = -data.gamma / self.h / right
+            b[-1] = 0
+
+            def bound_rhs(u, k, d):
+                d[0] = 1 / left * data.phi0(k * self.tau)
+                d[-1] = 1 / right * data.phil(k * self.tau)
+
+        elif data.bound_type == 'a2p3':
+            k1 = 2 * self.h * data.beta - 3 * data.alpha
+            omega = self.tau ** 2 * data.b / (2 * self.h)
+            xi = data.d * self.tau / 2
+
+            b[0] = 4 * data.alpha - data.alpha / (self.sigma + omega) * (1 + xi + 2 * self.sigma - data.c * self.tau ** 2)
+            c[0] = k1 - data.alpha * (omega - self.sigma) / (omega + self.sigma)
+            a[-1] = -data.gamma / (omega - self.sigma) * (1 + xi + 2 * self.sigma - data.c * self.tau ** 2) - 4 * data.gamma
+            b[-1] = 0
+
+            def bound_rhs(u, k, d):
+                d[0] = 2 * self.h * data.phi0(k * self.tau) + data.alpha * d[1] / (-self.sigma - omega)
+                d[-1] = 2 * self.h * data.phil(k * self.tau) - data.gamma * d[-2] / (omega - self.sigma)
+
+        elif data.bound_type == 'a2p2':
+            b[0] = 2 * data.a / self.h
+            c[0] = -2 * data.a / self.h + self.h / self.tau ** 2 - data.c * self.h + \
+                -data.d * self.h / (2 * self.tau) + \
+                data.beta / data.alpha * (2 * data.a + data.b * self.h)
+            a[-1] = -b[0]
+            b[-1] = 0
+
+            def bound_rhs(u, k, d):
+                d[0] = self.h / self.tau ** 2 * (u[k - 2][0] - 2 * u[k - 1][0]) - self.h * data.f() + \
+                    -data.d * self.h / (2 * self.tau) * u[k - 2][0] + \
+                    (2 * data.a - data.b * self.h) / data.alpha * data.phi0(k * self.tau)
+                d[-1] = self.h / self.tau ** 2 * (-u[k - 2][0] + 2 * u[k - 1][0]) + self.h * data.f() + \
+                    data.d * self.h / (2 * self.tau) * u[k - 2][0] + \
+                    (2 * data.a + data.b * self.h) / data.alpha * data.phil(k * self.tau)
+
+        else:
+            raise Exception(f"Bound type {data.bound_type} is not supported by implicit scheme")
+
+        return bound_rhs
+
     def _left_bound_a1p2(self, u, k, t):
         return -(self.data.alpha / self.h) / (self.data.beta - self.data.alpha / self.h) * u[k - 1][1] \
                + self.data.phi0(t) / (self.data.beta - self.data.alpha / self.h)
@@ -150,7 +282,7 @@ class HyperbolicSolver:
                         (2 * self.data.a + self.data.b * self.h) / self.data.gamma * self.data.phil(t))
 
     def _explicit_solve(self, N, K, T):
-        u = np.zeros((K, N))
+        u = zeros((K, N), self.data.dtype, self.data.scratch)
 
         for j in range(N):
             x = j * self.h
@@ -177,7 +309,12 @@ class HyperbolicSolver:
             left_bound = self._left_bound_a2p2
             right_bound = self._right_bound_a2p2
 
-        for k in range(2, K):
+        for k in range(self._resume(u, 2, K), K):
+            if self.deadline.expired():
+                return self._truncate(u, k, K)
+            self.reporter.report(step=k, steps=K)
+            if self.checkpointer is not None and self.checkpointer.due():
+                self.checkpointer.save(k - 1, u[:k])
             t = k * self.tau
             for j in range(1, N - 1):
                 u[k][j] = self.sigma * u[k - 1][j + 1] + \
@@ -1,6 +1,11 @@
+import os
+
 import numpy as np
 
-from utils import norm_inf, norm_inf_vec
+from utils import norm_inf, norm_inf_vec, Stencil
+from deadline import Deadline
+from progress import Progress
+from decomposition import Decomposition, stencil
 
 
 class EquationData:
@@ -10,11 +15,13 @@ class EquationData:
         self.phi2 = params['phi2']
         self.phi3 = params['phi3']
         self.solution = params['solution']
+        self.dtype = params.get('dtype', np.float64)
 
 
 class EllipticSolver:
     def __init__(self, params, equation_type):
         self.data = EquationData(params)
+        self.equation_type = equation_type
         try:
             self.solve_func = getattr(self, f'_{equation_type}_solve')
         except:
@@ -22,40 +29,82 @@ class EllipticSolver:
 
     def solve_analytic(self, N, l, eps):
         self.h = l / N;
-        u = np.zeros((N, N))
-        for x in range(N):
-            for y in range(N):
-                u[x][y] = self.data.solution(x * self.h, y * self.h)
-        return u
+        x = np.arange(N) * self.h
+        return self.data.solution(x[:, np.newaxis], x[np.newaxis, :]).astype(self.data.dtype)
 
-    def solve(self, N, l, eps):
+    def solve(self, N, l, eps, deadline=None, reporter=None, initial_guess=None, store=None, state_key=None,
+              check_every=4, max_iterations=10000, workers=1, sweeps=4):
         self.h = l / N
-        A, b = self._get_equation_system(N, l)
-        return self.solve_func(N, A, b, eps)
+        self.deadline = deadline or Deadline()
+        self.reporter = reporter or Progress()
+        self.check_every = check_every
+        self.max_iterations = max_iterations
+        self.truncated = False
+        self.converged = False
+        self.residuals = []
+        self.progress = {'iteration': 0}
+        self.warm_start = None
+        self.initial_guess = self._warm_start(N, initial_guess, store, state_key)
+        workers = min(workers, os.cpu_count())
+        if workers > 1:
+            u = self._decomposed_solve(N, eps, workers, sweeps)
+        else:
+            A, b = self._get_equation_system(N, l)
+            u = self.solve_func(N, A, b, eps)
+        if store is not None and self.converged:
+            store.save(state_key, N, u)
+        return u
+
+    def _warm_start(self, N, initial_guess, store, state_key):
+        """
+        Initial guess of the iterations: the given one, or the stored solution
+        of the finest grid not finer than N interpolated onto this grid.
+        """
+        if initial_guess is not None:
+            x = np.asarray(initial_guess, dtype=float).reshape(-1)
+            if len(x) != (N - 1) ** 2:
+                raise Exception(f"Initial guess must be a {N - 1} x {N - 1} matrix")
+            self.warm_start = {'source': 'initial_guess'}
+            return x
+        if store is None:
+            return None
+        state = store.nearest(state_key, N)
+        if state is None:
+            return None
+        coarse_N, u = state
+        self.warm_start = {'source': 'cache', 'N': coarse_N}
+        return self._interpolate(u, coarse_N, N).reshape(-1)
+
+    def _interpolate(self, u, coarse_N, N):
+        coarse = np.arange(1, coarse_N) / coarse_N
+        fine = np.arange(1, N) / N
+        rows = np.array([np.interp(fine, coarse, row) for row in u])
+        return np.array([np.interp(fine, coarse, column) for column in rows.T]).T
 
     def _leibmann_solve(self, N, A, b, eps):
         n = len(A)
         alpha, beta = self._find_equivalent_system(A, b)
         alpha_norm = norm_inf(alpha)
-        x = np.zeros(n)
-        x[:] = beta
+        x = np.zeros(n, dtype=self.data.dtype)
+        x[:] = beta if self.initial_guess is None else self.initial_guess
 
         while True:
-            next_x = np.zeros(n)
+            if self.deadline.expired():
+                self.truncated = True
+                break
+            self.progress['iteration'] += 1
+            next_x = np.zeros(n, dtype=self.data.dtype)
             for i in range(n):
                 sum_ = 0
                 for j in range(n):
                     sum_ += alpha[i][j] * x[j]
                 next_x[i] = beta[i] + sum_
             diff_x = next_x - x
-            if alpha_norm < 1:
-                end_cond = alpha_norm / (1 - alpha_norm) * norm_inf_vec(diff_x)
-            elif alpha_norm == 1:
-                end_cond = norm_inf_vec(diff_x)
-            else:
-                break
             x = next_x
-            if end_cond < eps:
+            if self.progress['iteration'] % self.check_every == 0 and \
+                    self._check_convergence(x, diff_x, alpha, beta, alpha_norm, eps):
+                break
+            if self.progress['iteration'] >= self.max_iterations:
                 break
         u = self._vector_to_matrix(x, N - 1)
 
@@ -64,12 +113,12 @@ class EllipticSolver:
     def _seidel_solve(self, N, A, b, eps):
         n = len(A)
         alpha, beta = self._find_equivalent_system(A, b)
-        x = np.zeros(n)
-        x[:] = beta
+        x = np.zeros(n, dtype=self.data.dtype)
+        x[:] = beta if self.initial_guess is None else self.initial_guess
 
-        E = np.zeros((n, n))
-        B = np.zeros((n, n))
-        C = np.zeros((n, n))
+        E = np.zeros((n, n), dtype=self.data.dtype)
+        B = np.zeros((n, n), dtype=self.data.dtype)
+        C = np.zeros((n, n), dtype=self.data.dtype)
 
         for i in range(n):
             for j in range(n):
@@ -84,7 +133,11 @@ class EllipticSolver:
         alpha_norm = norm_inf(alpha)
 
         while True:
-            next_x = np.zeros(n)
+            if self.deadline.expired():
+                self.truncated = True
+                break
+            self.progress['iteration'] += 1
+            next_x = np.zeros(n, dtype=self.data.dtype)
 
             for i in range(n):
                 sum_ = 0
@@ -95,23 +148,94 @@ class EllipticSolver:
                 next_x[i] = beta[i] + sum_
 
             diff_x = next_x - x
-            if alpha_norm < 1:
-                end_cond = alpha_norm / (1 - alpha_norm) * norm_inf_vec(diff_x)
-            elif alpha_norm == 1:
-                end_cond = norm_inf_vec(diff_x)
-            else:
-                break
             x = next_x
-            if end_cond < eps:
+            if self.progress['iteration'] % self.check_every == 0 and \
+                    self._check_convergence(x, diff_x, alpha, beta, alpha_norm, eps):
+                break
+            if self.progress['iteration'] >= self.max_iterations:
                 break
 
         u = self._vector_to_matrix(x, N - 1)
 
         return u
 
+    def _decomposed_solve(self, N, eps, workers, sweeps):
+        """
+        Block Jacobi over strips of the grid solved in parallel, the local
+        sweeps are Jacobi for leibmann and red-black Gauss-Seidel for seidel.
+        The dense matrices of the serial methods are never built.
+        """
+        sz = N - 1
+        weights, beta = self._stencil_system(N)
+        alpha_norm = norm_inf(Stencil(weights))
+        x0 = beta if self.initial_guess is None else self.initial_guess.reshape(sz, sz)
+
+        with Decomposition(weights, beta, x0, workers, sweeps, self.equation_type == 'seidel') as domain:
+            x = domain.buffers[domain.current]
+            while True:
+                if self.deadline.expired():
+                    self.truncated = True
+                    break
+                self.progress['iteration'] += 1
+                x, diff_x = domain.iterate()
+                if self.progress['iteration'] % self.check_every == 0:
+                    residual = float(norm_inf_vec(stencil(x.astype(np.float64), beta, weights) - x))
+                    if self._stop(residual, diff_x, alpha_norm, eps):
+                        break
+                if self.progress['iteration'] >= self.max_iterations:
+                    break
+            return np.array(x)
+
+    def _stencil_system(self, N):
+        """
+        x = beta + alpha x of _find_equivalent_system on the (N - 1) x (N - 1)
+        grid of unknowns, alpha given by the weights of the north, south, west
+        and east neighbours of every point.
+        """
+        sz = N - 1
+        i = np.arange(sz)[:, np.newaxis]
+        j = np.arange(sz)[np.newaxis, :]
+        weights = np.zeros((4, sz, sz))
+        weights[0] = i > 0
+        weights[1] = i < sz - 1
+        weights[2] = j > 0
+        weights[3] = j < sz - 1
+        diag = 4 - (i == sz - 1) - (j == sz - 1)
+
+        b = np.zeros((sz, sz))
+        b[0, :] -= self.data.phi0(j[0] * self.h)
+        b[:, 0] -= self.data.phi2(i[:, 0] * self.h)
+        return (weights / diag).astype(self.data.dtype), (-b / diag).astype(self.data.dtype)
+
+    def _check_convergence(self, x, diff_x, alpha, beta, alpha_norm, eps):
+        """
+        Records the residual of x = beta + alpha x and checks the stop condition.
+        The check runs in float64 whatever the dtype of the iterations.
+        """
+        residual = float(norm_inf_vec(beta + np.matmul(alpha, x, dtype=np.float64) - x))
+        return self._stop(residual, diff_x, alpha_norm, eps)
+
+    def _stop(self, residual, diff_x, alpha_norm, eps):
+        """
+        The stop condition: the a-priori estimate for a contraction,
+        the last update otherwise.
+        """
+        self.residuals.append(residual)
+        self.reporter.report(iteration=self.progress['iteration'], residual=residual)
+        if not np.isfinite(residual):
+            return True
+
+        diff_norm = norm_inf_vec(diff_x.astype(np.float64))
+        if alpha_norm < 1:
+            end_cond = alpha_norm / (1 - alpha_norm) * diff_norm
+        else:
+            end_cond = diff_norm
+        self.converged = bool(end_cond < eps)
+        return self.converged
+
     def _get_equation_system(self, N, l):
         sz = N - 1
-        A = np.zeros((sz * sz, sz * sz))
+        A = np.zeros((sz * sz, sz * sz), dtype=self.data.dtype)
         b = np.zeros(sz * sz)
         for i in range(sz):
             for j in range(sz):
@@ -141,8 +265,8 @@ class EllipticSolver:
 
     def _find_equivalent_system(self, A, b):
         n = len(A)
-        alpha = np.zeros((n, n))
-        beta = np.zeros(n)
+        alpha = np.zeros((n, n), dtype=self.data.dtype)
+        beta = np.zeros(n, dtype=self.data.dtype)
         for i in range(n):
             if A[i][i] == 0:
                 swap_flag = False
@@ -165,7 +289,7 @@ class EllipticSolver:
         return alpha, beta
 
     def _vector_to_matrix(self, vec, sz):
-        u = np.zeros((sz, sz))
+        u = np.zeros((sz, sz), dtype=self.data.dtype)
         for i in range(sz):
             u[i] = vec[i * sz:(i + 1) * sz]
         return u
@@ -1,6 +1,13 @@
+import os
+import math
+
 import numpy as np
 
-from utils import tma
+from utils import tma_factor
+from deadline import Deadline
+from progress import Progress
+from probes import Probes
+from sweeps import LineSweeps
 
 
 class EquationData:
@@ -14,23 +21,93 @@ class EquationData:
         self.phi2 = params['phi2']
         self.phi3 = params['phi3']
         self.solution = params['solution']
+        self.dtype = params.get('dtype', np.float64)
 
 
 class Parabolic2DSolver:
     def __init__(self, params, equation_type):
         self.data = EquationData(params)
+        self.equation_type = equation_type
         try:
             self.solve_func = getattr(self, f'_{equation_type}_solve')
         except:
             raise Exception("This type does not exist")
 
-    def solve(self, N1, N2, K, T):
+    def solve(self, N1, N2, K, T, deadline=None, reporter=None, checkpointer=None, probes=None, workers=1):
         self.tau = T / K
         self.h1 = self.data.l1 / N1;
         self.h2 = self.data.l2 / N2
         self.sigma = self.tau / (self.h1 ** 2)
         self.omega = self.tau / (self.h2 ** 2)
-        return self.solve_func(N1, N2, K, T)
+        self.deadline = deadline or Deadline()
+        self.reporter = reporter or Progress()
+        self.truncated = False
+        self.progress = {'step': N1, 'steps': N1}
+        self.checkpointer = checkpointer
+        self.probes = None
+        if probes is not None:
+            # ADI methods advance the time by h1 per step
+            step = self.tau if self.equation_type == 'explicit' else self.h1
+            self.probes = Probes(probes, self.h1, self.h2, N1, N2, self.data.solution, step)
+        if self.equation_type == 'explicit':
+            u = self.solve_func(N1, N2, K, T)
+        else:
+            with self._line_sweeps(N1, N2, min(workers, os.cpu_count())) as self.sweeps:
+                u = self.solve_func(N1, N2, K, T)
+        if checkpointer is not None and not self.truncated:
+            checkpointer.clear()
+        return u
+
+    def _line_sweeps(self, N1, N2, workers):
+        """
+        Line solves of the ADI half-steps, along x for the columns of dx
+        and along y for the columns of dy. The lines of a half-step are
+        independent, with workers > 1 they are split across processes.
+        """
+        factors_x = tma_factor(np.full(N1, self.sigma), np.full(N1, -(1 + 2 * self.sigma)),
+                               np.full(N1, self.sigma), self.data.dtype)
+        factors_y = tma_factor(np.full(N2, self.omega), np.full(N2, -(1 + 2 * self.omega)),
+                               np.full(N2, self.omega), self.data.dtype)
+        return LineSweeps([factors_x, factors_y], [(N1, N2 - 2), (N2, N1 - 2)], workers)
+
+    def _resume(self, u):
+        """
+        Restores the last layer of an interrupted run of this request into u,
+        returns the step to continue from and the other stored layer or None.
+        """
+        if self.checkpointer is None:
+            return 1, None
+        snapshot = self.checkpointer.load()
+        if snapshot is None:
+            return 1, None
+        step, layers = snapshot
+        u[:] = layers[0]
+        # the snapshot has no earlier layers, probe times before it are missed
+        if self.probes is not None:
+            t = (step + 1) * self.h1
+            self.probes.skip(t)
+            self._record(t, u)
+        return step + 1, np.copy(layers[1]) if len(layers) > 1 else None
+
+    def _record(self, t, layer):
+        if self.probes is not None:
+            self.probes.record(t, layer)
+
+    def _save(self, k, u, kept):
+        # a snapshot holds the last layer and the one to be returned, if known
+        if k > 1:
+            self.checkpointer.save(k - 1, [u] if kept is None else [u, kept])
+
+    def _checkpoint(self, k, u, kept):
+        if self.checkpointer is not None and self.checkpointer.due():
+            self._save(k, u, kept)
+
+    def _truncate(self, k, steps, u, kept):
+        self.truncated = True
+        self.progress = {'step': k, 'steps': steps}
+        if self.checkpointer is not None:
+            self._save(k, u, kept)
+        return u
 
     def solve_analytic(self, N1, N2, K, T):
         self.tau = T / K
@@ -50,191 +127,176 @@ class Parabolic2DSolver:
             for i in range(N2):
                 u_y[k][i] = self.data.solution(0.1, i * self.h2, k * self.tau)
 
-        u = np.zeros((K, N1, N2))
-        for k in range(K):
-            for j in range(N1):
-                for i in range(N2):
-                    u[k][j][i] = self.data.solution(j * self.h1, i * self.h2, k * self.tau)
+        # only the middle layer is returned
+        u = np.zeros((N1, N2))
+        k = K // 2
+        for j in range(N1):
+            for i in range(N2):
+                u[j][i] = self.data.solution(j * self.h1, i * self.h2, k * self.tau)
 
-        return {'grid_x': u_x.tolist(), 'grid_y': u_y.tolist(), 'grid': u[int(len(u) // 2)].tolist()}
+        return {'grid_x': u_x.tolist(), 'grid_y': u_y.tolist(), 'grid': u.tolist()}
 
 
     def _alter_directions_solve(self, N1, N2, K, T):
-        ax = np.zeros(N1)
-        bx = np.zeros(N1)
-        cx = np.zeros(N1)
-        dx = np.zeros(N1)
+        x = np.arange(N1) * self.h1
+        y = np.arange(N2) * self.h2
 
-        ay = np.zeros(N2)
-        by = np.zeros(N2)
-        cy = np.zeros(N2)
-        dy = np.zeros(N2)
+        prev_solution = np.zeros((N1, N2), dtype=self.data.dtype)
+        cur_solution = np.zeros((N1, N2), dtype=self.data.dtype)
+        u3 = np.zeros((N1, N2), dtype=self.data.dtype)
+        dx, dy = self.sweeps.rhs
 
-        for i in range(N1):
-            ax[i] = self.sigma
-            bx[i] = -(1 + 2 * self.sigma)
-            cx[i] = self.sigma
+        # the layer of this step is returned
+        middle_step = (N1 - 1) // 2 + 1
 
-        for j in range(N2):
-            ay[j] = self.omega
-            by[j] = -(1 + 2 * self.omega)
-            cy[j] = self.omega
+        prev_solution[:] = self.data.psi(x[:, np.newaxis], y[np.newaxis, :])
+        self._record(0, prev_solution)
 
-        prev_solution = np.zeros((N1, N2))
-        cur_solution = np.zeros((N1, N2))
-        u3 = np.zeros((N1, N2))
+        first, middle = self._resume(prev_solution)
 
-        results = []
-
-        for i in range(N1):
-            for j in range(N2):
-                prev_solution[i][j] = self.data.psi(i * self.h1, j * self.h2)
-
-        for k in range(1, N1):
+        for k in range(first, N1):
+            if self.deadline.expired():
+                return self._truncate(k, N1, prev_solution, middle)
+            self.reporter.report(step=k, steps=N1)
+            self._checkpoint(k, prev_solution, middle)
             tk1 = (k + 0.5) * self.h1
             tk2 = (k + 1) * self.h1
-
-            for j in range(1, N2 - 1):
-                yj = j * self.h2
-
-                dx[0] = self.data.phi0(yj, tk2)
-                dx[-1] = self.data.phi1(yj, tk2)
-
-                for i in range(1, N1 - 1):
-                    xi = i * self.h1
-                    dx[i] = -self.omega * prev_solution[i][j + 1] \
-                            + (2 * self.omega - 1) * prev_solution[i][j] \
-                            - self.omega * prev_solution[i][j - 1] \
-                            - self.h1 / 2 * self.data.f(xi, yj, tk2)
-
-                ux = tma(ax, bx, cx, dx)
-                for i in range(N1):
-                    cur_solution[i][j] = ux[i]
-
-            for i in range(N1):
-                cur_solution[i][0] = 0
-                cur_solution[i][-1] = 0
-
-            for i in range(N1):
-                cur_solution[i][0] = self.data.phi2(i * self.h1, tk1)
-                cur_solution[i][-1] = cur_solution[i][-2] + self.h2 * self.data.phi3(i * self.h1, tk1)
-
-
-            for i in range(1, N1 - 1):
-                xi = i * self.h1
-
-                dy[0] = self.data.phi2(xi, tk2)
-                dy[-1] = self.h2 * self.data.phi3(xi, tk2)
-
-                for j in range(1, N2 - 1):
-                    yj = j * self.h2
-                    dy[j] = -self.sigma * cur_solution[i + 1][j] \
-                            + (2 * self.sigma - 1) * cur_solution[i][j] \
-                            - self.sigma * cur_solution[i - 1][j] \
-                            - self.h1 / 2 * self.data.f(xi, yj, tk2)
-
-                uy = tma(ay, by, cy, dy)
-                for j in range(N2):
-                    u3[i][j] = uy[j]
-
-            for j in range(N2):
-                u3[0][j] = 0
-                u3[-1][j] = 0
-
-            for j in range(N2):
-                u3[0][j] = self.data.phi0(j * self.h2, tk2)
-                u3[-1][j] = u3[-2][j] + self.h1 * self.data.phi1(j * self.h2, tk2)
-
-            results.append(np.copy(u3))
+            f = self.data.f(x[1:-1, np.newaxis], y[np.newaxis, 1:-1], tk2)
+
+            dx[0] = self.data.phi0(y[1:-1], tk2)
+            dx[-1] = self.data.phi1(y[1:-1], tk2)
+            dx[1:-1] = -self.omega * prev_solution[1:-1, 2:] \
+                       + (2 * self.omega - 1) * prev_solution[1:-1, 1:-1] \
+                       - self.omega * prev_solution[1:-1, :-2] \
+                       - self.h1 / 2 * f
+            cur_solution[:, 1:-1] = self.sweeps.solve(0)
+
+            cur_solution[:, 0] = self.data.phi2(x, tk1)
+            cur_solution[:, -1] = cur_solution[:, -2] + self.h2 * self.data.phi3(x, tk1)
+
+            dy[0] = self.data.phi2(x[1:-1], tk2)
+            dy[-1] = self.h2 * self.data.phi3(x[1:-1], tk2)
+            dy[1:-1] = (-self.sigma * cur_solution[2:, 1:-1]
+                        + (2 * self.sigma - 1) * cur_solution[1:-1, 1:-1]
+                        - self.sigma * cur_solution[:-2, 1:-1]
+                        - self.h1 / 2 * f).T
+            u3[1:-1] = self.sweeps.solve(1).T
+
+            u3[0] = self.data.phi0(y, tk2)
+            u3[-1] = u3[-2] + self.h1 * self.data.phi1(y, tk2)
+
+            self._record(tk2, u3)
+            if k == middle_step:
+                middle = np.copy(u3)
 
             prev_solution, u3 = u3, prev_solution
 
-        return results[int(len(results) // 2)]
+        return middle
 
 
     def _fract_steps_solve(self, N1, N2, K, T):
-        ax = np.zeros(N1)
-        bx = np.zeros(N1)
-        cx = np.zeros(N1)
-        dx = np.zeros(N1)
-
-        ay = np.zeros(N2)
-        by = np.zeros(N2)
-        cy = np.zeros(N2)
-        dy = np.zeros(N2)
-
-        for i in range(N1):
-            ax[i] = self.sigma
-            bx[i] = -(2 * self.sigma + 1)
-            cx[i] = self.sigma
-
-        for j in range(N2):
-            ay[j] = self.omega
-            by[j] = - (2 * self.omega + 1)
-            cy[j] = self.omega
-
-        u1 = np.zeros((N1, N2))
-        u2 = np.zeros((N1, N2))
-        u3 = np.zeros((N1, N2))
-        ux = np.zeros(N1)
-        uy = np.zeros(N2)
-
-        results = []
-
-        for i in range(N1):
-            for j in range(N2):
-                u1[i][j] = self.data.psi(i * self.h1, j * self.h2)
-
-        for k in range(1, N1):
+        x = np.arange(N1) * self.h1
+        y = np.arange(N2) * self.h2
+
+        u1 = np.zeros((N1, N2), dtype=self.data.dtype)
+        u2 = np.zeros((N1, N2), dtype=self.data.dtype)
+        u3 = np.zeros((N1, N2), dtype=self.data.dtype)
+        dx, dy = self.sweeps.rhs
+
+        u1[:] = self.data.psi(x[:, np.newaxis], y[np.newaxis, :])
+        self._record(0, u1)
+
+        # u3 holds the previous layer, the one returned
+        first, previous = self._resume(u1)
+        if previous is not None:
+            u3[:] = previous
+
+        for k in range(first, N1):
+            if self.deadline.expired():
+                return self._truncate(k, N1, u1, u3)
+            self.reporter.report(step=k, steps=N1)
+            self._checkpoint(k, u1, u3)
             tk1 = (k + 0.5) * self.h1
             tk2 = (k + 1) * self.h1
+            f = self.data.f(x[1:-1, np.newaxis], y[np.newaxis, 1:-1], tk2)
 
-            for j in range(1, N2 - 1):
-                yj = j * self.h2
-
-                dx[0] = self.data.phi0(yj, tk2)
-                dx[-1] = self.h1 * self.data.psi(yj, tk2)
-
-                for i in range(1, N1 - 1):
-                    xi = i * self.h1
-                    dx[i] = -self.h1 / 2 * self.data.f(xi, yj, tk2)
-
-                ux = tma(ax, bx, cx, dx)
-                for i in range(N1):
-                    u2[i][j] = ux[i]
-
-            for i in range(N1):
-                u2[i][0] = 0
-                u2[i][-1] = 0
-
-            for i in range(N1):
-                u2[i][0] = self.data.phi2(i * self.h1, tk1)
-                u2[i][-1] = u2[i][-2] + self.h2 * self.data.phi3(i * self.h1, tk1)
-
-            for i in range(1, N1 - 1):
-                xi = i * self.h1
-
-                dy[0] = self.data.phi2(xi, tk2)
-                dy[-1] = self.h2 * self.data.phi3(xi, tk2)
-
-                for j in range(1, N2 - 1):
-                    yj = j * self.h2
-                    dy[j] = -self.h1 / 2 * self.data.f(xi, yj, tk2)
+            dx[0] = self.data.phi0(y[1:-1], tk2)
+            dx[-1] = self.h1 * self.data.psi(y[1:-1], tk2)
+            dx[1:-1] = -self.h1 / 2 * f
+            u2[:, 1:-1] = self.sweeps.solve(0)
 
-                uy = tma(ay, by, cy, dy)
-                for j in range(N2):
-                    u3[i][j] = uy[j]
+            u2[:, 0] = self.data.phi2(x, tk1)
+            u2[:, -1] = u2[:, -2] + self.h2 * self.data.phi3(x, tk1)
 
-            for j in range(N2):
-                u3[0][j] = 0
-                u3[-1][j] = 0
+            dy[0] = self.data.phi2(x[1:-1], tk2)
+            dy[-1] = self.h2 * self.data.phi3(x[1:-1], tk2)
+            dy[1:-1] = (-self.h1 / 2 * f).T
+            u3[1:-1] = self.sweeps.solve(1).T
 
-            for j in range(N2):
-                u3[0][j] = self.data.phi0(j * self.h2, tk2)
-                u3[-1][j] = u3[-2][j] + self.h1 * self.data.phi1(j * self.h2, tk2)
+            u3[0] = self.data.phi0(y, tk2)
+            u3[-1] = u3[-2] + self.h1 * self.data.phi1(y, tk2)
 
-            results.append(np.copy(u3))
+            self._record(tk2, u3)
 
             u1, u3 = u3, u1
 
-        return results[-2]
+        return u3
+
+    def _explicit_solve(self, N1, N2, K, T):
+        """
+        Explicit five-point scheme over K steps of tau on the whole grid,
+        returns the layer K // 2 like solve_analytic.
+        """
+        limit = 1 / (2 * (1 / self.h1 ** 2 + 1 / self.h2 ** 2))
+        if self.tau > limit:
+            raise Exception(f"Explicit scheme is unstable for tau = {self.tau:.3g}, "
+                            f"it needs tau <= {limit:.3g}, i.e. K >= {math.ceil(T / limit)}")
+
+        x = np.arange(N1) * self.h1
+        y = np.arange(N2) * self.h2
+        X, Y = x[1:-1, np.newaxis], y[np.newaxis, 1:-1]
+
+        u = np.zeros((N1, N2), dtype=self.data.dtype)
+        u[:] = self.data.psi(x[:, np.newaxis], y[np.newaxis, :])
+        self._record(0, u)
+        middle = np.copy(u) if K // 2 == 0 else None
+
+        first = 1
+        snapshot = self.checkpointer.load() if self.checkpointer is not None else None
+        if snapshot is not None:
+            step, layers = snapshot
+            u[:] = layers[0]
+            middle = np.copy(layers[1]) if len(layers) > 1 else None
+            first = step + 1
+            # the snapshot has no earlier layers, probe times before it are missed
+            if self.probes is not None:
+                self.probes.skip(step * self.tau)
+                self._record(step * self.tau, u)
+
+        for k in range(first, K):
+            if self.deadline.expired():
+                self.truncated = True
+                self.progress = {'step': k, 'steps': K}
+                if self.checkpointer is not None:
+                    self.checkpointer.save(k - 1, [u] if middle is None else [u, middle])
+                return u
+            self.reporter.report(step=k, steps=K)
+            if self.checkpointer is not None and self.checkpointer.due():
+                self.checkpointer.save(k - 1, [u] if middle is None else [u, middle])
+
+            t = k * self.tau
+            u[1:-1, 1:-1] += self.sigma * (u[2:, 1:-1] - 2 * u[1:-1, 1:-1] + u[:-2, 1:-1]) \
+                + self.omega * (u[1:-1, 2:] - 2 * u[1:-1, 1:-1] + u[1:-1, :-2]) \
+                + self.tau * self.data.f(X, Y, t - self.tau)
+
+            u[:, 0] = self.data.phi2(x, t)
+            u[:, -1] = u[:, -2] + self.h2 * self.data.phi3(x, t)
+            u[0] = self.data.phi0(y, t)
+            u[-1] = u[-2] + self.h1 * self.data.phi1(y, t)
+            self._record(t, u)
+
+            if k == K // 2:
+                middle = np.copy(u)
+
+        self.progress = {'step': K, 'steps': K}
+        return middle
@@ -1,19 +1,172 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import json
+import importlib
 
 import numpy as np
 
-from lab5 import ParabolicSolver
-from lab6 import HyperbolicSolver
-from lab7 import EllipticSolver
-from lab8 import Parabolic2DSolver
+from cost import admit, MAX_ADAPTIVE_STEPS
+from deadline import Deadline
+from progress import Progress, stderr_callback
+from checkpoint import StateStore, Checkpointer
+from expressions import compile_problem
+from scratch import SCRATCH_DIR
 
 # from mylab5 import Task as Lab5
 
+# solver modules are imported on first use, a request needs only one of them
+SOLVERS = {
+    5: ('lab5', 'ParabolicSolver'),
+    6: ('lab6', 'HyperbolicSolver'),
+    7: ('lab7', 'EllipticSolver'),
+    8: ('lab8', 'Parabolic2DSolver'),
+}
+_loaded_solvers = {}
 
-def solve_lab5(data):
+# identical requests running at the same time are solved once, see coalesce.py
+COALESCE = os.environ.get('LABS_COALESCE', '1') != '0'
+
+# precisions of the solver arrays a request may choose
+DTYPES = {'float64': np.float64, 'float32': np.float32}
+
+# variables of the problem functions a request may redefine by expressions
+PROBLEM_SIGNATURES = {
+    5: {'psi': ('x',), 'f': ('x', 't'), 'phi0': ('t',), 'phil': ('t',), 'solution': ('x', 't')},
+    6: {'f': (), 'psi1': ('x',), 'psi2': ('x',), 'psi1_dir1': ('x',), 'psi1_dir2': ('x',),
+        'phi0': ('t',), 'phil': ('t',), 'solution': ('x', 't')},
+    7: {'phi0': ('y',), 'phi1': ('y',), 'phi2': ('x',), 'phi3': ('x',), 'solution': ('x', 'y')},
+    8: {'f': ('x', 'y', 't'), 'psi': ('x', 'y'), 'phi0': ('x', 't'), 'phi1': ('x', 't'),
+        'phi2': ('y', 't'), 'phi3': ('y', 't'), 'solution': ('x', 'y', 't')},
+}
+
+
+def get_solver(lab_id):
+    if lab_id not in _loaded_solvers:
+        module_name, class_name = SOLVERS[lab_id]
+        module = importlib.import_module(module_name)
+        _loaded_solvers[lab_id] = getattr(module, class_name)
+    return _loaded_solvers[lab_id]
+
+
+def get_dtype(data):
+    name = data.get('dtype', 'float64')
+    if name not in DTYPES:
+        raise Exception(f"Unsupported dtype {name}")
+    return DTYPES[name]
+
+
+def get_scratch(data):
+    return SCRATCH_DIR if data.get('spill') else None
+
+
+def to_output(data, u):
+    """
+    Spilled and float32 outputs stay arrays, dump streams them row by row.
+    """
+    u = np.asarray(u)
+    if data.get('spill') or u.dtype == np.float32:
+        return u
+    return u.tolist()
+
+
+def _dump_row(u, out):
+    if u.dtype == np.float32 and u.ndim == 1 and np.isfinite(u).all():
+        # numpy prints float32 values by their shortest repr,
+        # tolist() would expand them to float64 digits
+        out.write('[' + ', '.join(u.astype(str)) + ']')
+    else:
+        json.dump(u.tolist(), out)
+
+
+def dump(resp, out):
+    """
+    json.dump that writes numpy arrays row by row, so a memory-mapped
+    output is never loaded as a whole.
+    """
+    if isinstance(resp, dict):
+        out.write('{')
+        for i, (key, value) in enumerate(resp.items()):
+            if i:
+                out.write(', ')
+            out.write(json.dumps(key) + ': ')
+            dump(value, out)
+        out.write('}')
+    elif isinstance(resp, np.ndarray) and resp.ndim > 1:
+        out.write('[')
+        for i, row in enumerate(resp):
+            if i:
+                out.write(', ')
+            dump(row, out)
+        out.write(']')
+    elif isinstance(resp, np.ndarray):
+        _dump_row(resp, out)
+    else:
+        json.dump(resp, out)
+
+
+def get_parareal(data):
+    options = data.get('parareal')
+    if not options:
+        return None
+    if data.get('resume') or data.get('checkpoint'):
+        raise Exception("Parareal cannot be combined with resume or checkpoint")
+    if data.get('richardson') or data.get('adaptive'):
+        raise Exception("Parareal cannot be combined with richardson or adaptive")
+    options = options if isinstance(options, dict) else {}
+    slices = int(options.get('slices', os.cpu_count()))
+    return {
+        'slices': slices,
+        'coarsening': int(options.get('coarsening', 10)),
+        'tol': float(options.get('tol', 1e-6)),
+        'iterations': int(options.get('iterations', slices)),
+        'workers': min(int(options.get('workers') or os.cpu_count()), os.cpu_count()),
+    }
+
+
+def get_deadline(data):
+    budget = data.get('time_budget')
+    return Deadline(None if budget is None else float(budget))
+
+
+def get_reporter(data, lab_id):
+    if not data.get('progress'):
+        return Progress()
+
+    def callback(event):
+        event['lab'] = lab_id
+        stderr_callback(event)
+
+    return Progress(callback, float(data.get('progress_interval', 0.5)))
+
+
+def get_params(data, lab_id, params):
+    if 'problem' not in data:
+        return params
+    return compile_problem(data['problem'], PROBLEM_SIGNATURES[lab_id], params)
+
+
+def problem_key(data):
+    problem = data.get('problem')
+    return () if problem is None else (json.dumps(problem, sort_keys=True),)
+
+
+def get_state(data, lab_id, *discretization):
+    if not data.get('resume'):
+        return None, None
+    key = ':'.join(str(value) for value in (lab_id, data['equation_type']) + discretization + problem_key(data))
+    return StateStore(), key
+
+
+def get_checkpointer(data, lab_id, *discretization):
+    if not data.get('checkpoint'):
+        return None
+    key = ':'.join(str(value) for value in (lab_id, data['equation_type']) + discretization + problem_key(data))
+    return Checkpointer(key, float(data.get('checkpoint_interval', 30)))
+
+
+def solve_lab5(data, numerical=True, analytic=True):
     # task = Lab5(a_condition=lambda a: a > 0,
     #      l0_beta=1,
     #      l1_beta=1,
@@ -36,18 +189,46 @@ def solve_lab5(data):
         'phil': lambda t: -np.exp(-0.5 * t),
         'solution': lambda x, t: np.exp(-0.5 * t) * np.sin(x),
         'bound_type': 'a1p2',
+        'theta': float(data.get('theta', 0.5)),
+        'dtype': get_dtype(data),
+        'scratch': get_scratch(data),
     }
 
-    p1d7 = ParabolicSolver(params, equation_type)
-    resp = {
-        'numerical': p1d7.solve(N, K, T).tolist(),
-        'analytic': p1d7.solve_analytic(N, K, T).tolist()
-    }
+    p1d7 = get_solver(5)(get_params(data, 5, params), equation_type)
+    resp = {}
+    first, last = 0, K
+    if numerical:
+        store, state_key = get_state(data, 5, params['theta'], N, T / K)
+        adaptive = None
+        if data.get('adaptive'):
+            adaptive = {'atol': float(data.get('atol', 1e-4)), 'rtol': float(data.get('rtol', 0)),
+                        'max_steps': int(data.get('max_steps', MAX_ADAPTIVE_STEPS))}
+        parareal = get_parareal(data)
+        u = p1d7.solve(N, K, T, deadline=get_deadline(data), reporter=get_reporter(data, 5),
+                       store=store, state_key=state_key, richardson=bool(data.get('richardson')),
+                       adaptive=adaptive, parareal=parareal)
+        first, last = p1d7.first_step, len(u)
+        resp['numerical'] = to_output(data, u[first:])
+        resp['truncated'] = p1d7.truncated
+        resp['progress'] = p1d7.progress
+        if store is not None:
+            resp['first_step'] = first
+        if data.get('richardson'):
+            resp['error_estimate'] = p1d7.error_estimate
+        if adaptive is not None:
+            resp['times'] = p1d7.times
+        if parareal is not None:
+            resp['parareal'] = p1d7.parareal
+    if analytic:
+        if numerical and p1d7.times is not None:
+            resp['analytic'] = to_output(data, p1d7.solve_analytic(N, K, T, p1d7.times))
+        else:
+            resp['analytic'] = to_output(data, p1d7.solve_analytic(N, K, T)[first:last])
 
     return resp
 
 
-def solve_lab6(data):
+def solve_lab6(data, numerical=True, analytic=True):
     equation_type = data['equation_type']
     N, K, T = int(data['N']), int(data['K']), int(data['T'])
 
@@ -71,18 +252,37 @@ def solve_lab6(data):
         'bound_type': 'a1p2',
         'approximation': 'p1',
         'solution': lambda x, t: np.exp(-t - x) * np.cos(x) * np.cos(2 * t),
+        'dtype': get_dtype(data),
+        'scratch': get_scratch(data),
     }
 
-    h2d7 = HyperbolicSolver(params, equation_type)
-    resp = {
-        'numerical': h2d7.solve(N, K, T).tolist(),
-        'analytic': h2d7.solve_analytic(N, K, T).tolist()
-    }
+    h2d7 = get_solver(6)(get_params(data, 6, params), equation_type)
+    resp = {}
+    first, last = 0, K
+    if numerical:
+        store, state_key = get_state(data, 6, N, T / K)
+        checkpointer = get_checkpointer(data, 6, N, K, T)
+        parareal = get_parareal(data)
+        u = h2d7.solve(N, K, T, deadline=get_deadline(data), reporter=get_reporter(data, 6),
+                       store=store, state_key=state_key, checkpointer=checkpointer,
+                       richardson=bool(data.get('richardson')), parareal=parareal)
+        first, last = h2d7.first_step, len(u)
+        resp['numerical'] = to_output(data, u[first:])
+        resp['truncated'] = h2d7.truncated
+        resp['progress'] = h2d7.progress
+        if store is not None:
+            resp['first_step'] = first
+        if data.get('richardson'):
+            resp['error_estimate'] = h2d7.error_estimate
+        if parareal is not None:
+            resp['parareal'] = h2d7.parareal
+    if analytic:
+        resp['analytic'] = to_output(data, h2d7.solve_analytic(N, K, T)[first:last])
 
     return resp
 
 
-def solve_lab7(data):
+def solve_lab7(data, numerical=True, analytic=True):
     equation_type = data['equation_type']
     N, l, eps = int(data['N']), int(data['l']), float(data['eps'])
 
@@ -92,18 +292,34 @@ def solve_lab7(data):
         'phi2': lambda x: np.cos(x),
         'phi3': lambda x: 0,
         'solution': lambda x, y: np.cos(x) * np.cos(y),
+        'dtype': get_dtype(data),
+        'scratch': get_scratch(data),
     }
 
-    e2d7 = EllipticSolver(params, equation_type)
-    resp = {
-        'numerical': e2d7.solve(N, l, eps).tolist(),
-        'analytic': e2d7.solve_analytic(N, l, eps).tolist()
-    }
+    e2d7 = get_solver(7)(get_params(data, 7, params), equation_type)
+    resp = {}
+    if numerical:
+        # the solution does not depend on the method, so every method shares the stored grids
+        store = StateStore() if data.get('warm_start') else None
+        u = e2d7.solve(N, l, eps, deadline=get_deadline(data), reporter=get_reporter(data, 7),
+                       initial_guess=data.get('initial_guess'),
+                       store=store, state_key=':'.join((f'7:{l}',) + problem_key(data)),
+                       check_every=int(data.get('check_every', 4)),
+                       max_iterations=int(data.get('max_iterations', 10000)),
+                       workers=int(data.get('workers', 1)), sweeps=int(data.get('sweeps', 4)))
+        resp['numerical'] = to_output(data, u)
+        resp['truncated'] = e2d7.truncated
+        resp['progress'] = e2d7.progress
+        resp['converged'] = e2d7.converged
+        resp['residuals'] = e2d7.residuals
+        resp['warm_start'] = e2d7.warm_start
+    if analytic:
+        resp['analytic'] = to_output(data, e2d7.solve_analytic(N, l, eps))
 
     return resp
 
 
-def solve_lab8(data):
+def solve_lab8(data, numerical=True, analytic=True):
     equation_type = data['equation_type']
     N1, N2, K, T = int(data['N1']), int(
         data['N2']), int(data['K']), int(data['T'])
@@ -117,30 +333,62 @@ def solve_lab8(data):
         'phi1': lambda x, t: x * np.cos(t),
         'phi2': lambda y, t: 0,
         'phi3': lambda y, t: y * np.cos(t),
-        'solution': lambda x, y, t: x * y * np.cos(t)
+        'solution': lambda x, y, t: x * y * np.cos(t),
+        'dtype': get_dtype(data),
     }
 
-    p2d7 = Parabolic2DSolver(params, equation_type)
-    resp = {
-        'numerical': p2d7.solve(N1, N2, K, T).tolist(),
-        'analytic': p2d7.solve_analytic(N1, N2, K, T)
-    }
+    p2d7 = get_solver(8)(get_params(data, 8, params), equation_type)
+    resp = {}
+    if numerical:
+        checkpointer = get_checkpointer(data, 8, N1, N2, K, T)
+        u = p2d7.solve(N1, N2, K, T, deadline=get_deadline(data), reporter=get_reporter(data, 8),
+                       checkpointer=checkpointer, probes=data.get('probes'), workers=int(data.get('workers', 1)))
+        if p2d7.probes is not None:
+            resp['numerical'], probes_analytic = p2d7.probes.result()
+        else:
+            resp['numerical'] = to_output(data, u)
+        resp['truncated'] = p2d7.truncated
+        resp['progress'] = p2d7.progress
+    if analytic:
+        if numerical and p2d7.probes is not None:
+            resp['analytic'] = probes_analytic
+        else:
+            resp['analytic'] = p2d7.solve_analytic(N1, N2, K, T)
 
     return resp
 
 
+LABS = {
+    5: solve_lab5,
+    6: solve_lab6,
+    7: solve_lab7,
+    8: solve_lab8,
+}
+
+
 def get_solution(data, lab_id):
-    if lab_id == 5:
-        return solve_lab5(data)
-    elif lab_id == 6:
-        return solve_lab6(data)
-    elif lab_id == 7:
-        return solve_lab7(data)
-    elif lab_id == 8:
-        return solve_lab8(data)
+    data, admission = admit(data, lab_id)
+    resp = LABS[lab_id](data)
+
+    if admission is not None:
+        resp['admission'] = admission
+    return resp
 
 
 if __name__ == '__main__':
     data = json.load(sys.stdin)
     lab_id = int(sys.argv[1])
-    json.dump(get_solution(data, lab_id), sys.stdout)
+
+    def write(out):
+        if 'jobs' in data:
+            from batch import solve_batch
+            solve_batch(data, lab_id, out)
+        else:
+            dump(get_solution(data, lab_id), out)
+
+    # streamed batches are written as they finish and cannot be shared
+    if COALESCE and not data.get('stream'):
+        from coalesce import request_key, solve_once
+        solve_once(request_key(data, lab_id), write, sys.stdout)
+    else:
+        write(sys.stdout)
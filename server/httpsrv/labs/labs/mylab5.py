@@ -1,6 +1,29 @@
 import math
 
-import matplotlib.pyplot as plt
+import numpy as np
+
+from utils import tma_factor, tma_solve
+from forkpool import ForkPool, shared
+
+
+def _sweep_error(run):
+    solve_type, approximation_type, k, n = run
+    _, _, err = shared().solve(solve_type=solve_type, approximation_type=approximation_type, k=k, n=n)
+    if err is None:
+        return math.nan
+    return np.max(np.abs(err))
+
+
+def _on_grid(func, shape, **args):
+    """
+    Evaluates func on coordinate arrays,
+    element by element when func works on scalars only.
+    """
+    try:
+        values = func(**args)
+    except (TypeError, ValueError):
+        values = np.vectorize(lambda **point: func(**point))(**args)
+    return np.broadcast_to(np.asarray(values, dtype=float), shape)
 
 
 class Task:
@@ -297,30 +320,31 @@ class Task:
             self.__schema_coefficients['u^k+1_j-1'],
             self.__schema_coefficients['u^k+1_j'],
             self.__schema_coefficients['u^k+1_j+1'],
-            lambda u1, u2, u3, x, t:
-                + self.__schema_coefficients['u^k_j-1'] * u1
-                + self.__schema_coefficients['u^k_j'] * u2
-                + self.__schema_coefficients['u^k_j+1'] * u3
-                + self.__schema_coefficients['f^k+1'] * self.__free_function(x=x, t=t)
-                + self.__schema_coefficients['f^k'] * self.__free_function(x=x, t=t - self.__tau)
         ]
 
         self.__approximate_last_line(approximation_type)
 
 
     def __prepare_to_run_trough(self, coefs):
+        """
+        Brings the first and the last lines of the n x 3 coefficients array
+        to tridiagonal form. Returns for both of them the line and the factor
+        its right-hand side must be subtracted with on every step.
+        """
+        first_fix = last_fix = None
+
         if coefs[0][0] != 0:
             if coefs[1][2] != 0:
                 k = coefs[0][0] / coefs[1][2]
                 coefs[0][0] = 0
                 coefs[0][1] -= coefs[1][0] * k
                 coefs[0][2] -= coefs[1][1] * k
-                coefs[0][-1] -= coefs[1][-1] * k
+                first_fix = (1, k)
             else:
                 k = coefs[0][0] / coefs[2][1]
                 coefs[0][0] = 0
                 coefs[0][2] -= coefs[2][0] * k
-                coefs[0][-1] -= coefs[2][-1] * k
+                first_fix = (2, k)
 
         if coefs[-1][2] != 0:
             if coefs[-2][0] != 0:
@@ -328,12 +352,14 @@ class Task:
                 coefs[-1][2] = 0
                 coefs[-1][1] -= coefs[-2][2] * k
                 coefs[-1][0] -= coefs[-2][1] * k
-                coefs[-1][-1] -= coefs[-2][-1] * k
+                last_fix = (-2, k)
             else:
                 k = coefs[-1][2] / coefs[-3][1]
                 coefs[-1][2] = 0
                 coefs[-1][0] -= coefs[-3][2] * k
-                coefs[-1][-1] -= coefs[-3][-1] * k
+                last_fix = (-3, k)
+
+        return first_fix, last_fix
 
     def __diagonal_predominance(self, coefs):
         has_strong = False
@@ -344,22 +370,6 @@ class Task:
                 has_strong = True
         return has_strong
 
-    def __run_through(self, coefs):
-        for line_ind in range(1, self.__n):
-            k = coefs[line_ind][0] / coefs[line_ind - 1][1]
-            coefs[line_ind][0] = 0
-            coefs[line_ind][1] -= k * coefs[line_ind - 1][2]
-            coefs[line_ind][-1] -= k * coefs[line_ind - 1][-1]
-
-        for line_ind in range(self.__n - 2, -1, -1):
-            k = coefs[line_ind][2] / coefs[line_ind + 1][1]
-            coefs[line_ind][2] = 0
-            coefs[line_ind][-1] -= k * coefs[line_ind + 1][-1]
-
-        for line_ind in range(self.__n):
-            coefs[line_ind][-1] /= coefs[line_ind][1]
-            coefs[line_ind][1] = 1
-
     def solve(self, solve_type=None, approximation_type=None, k=None, n=None, courant=0.5, theta=None):
         if not self.__constants_set:
             print('constants in the task are not set')
@@ -409,35 +419,52 @@ class Task:
 
         self.__make_coefficients_matrix(approximation_type)
 
-        res = []
-        pillar_line = [self.__t_cond.f(self.__l0 + self.__h * i) for i in range(self.__n)]
-        res.append([self.__t_cond.f(self.__l0 + self.__h * i) for i in range(self.__n)])
+        n = self.__n
+        x = self.__l0 + self.__h * np.arange(n)
+        t = self.__tau * np.arange(self.__k)
+        X, T = np.meshgrid(x, t)
 
-        for tk in range(1, self.__k):
-            coefs = [
-                [coef for coef in self.__first_coefficients[:-1]] +
-                [self.__first_coefficients[-1](pillar_line[0], pillar_line[1], self.__l0, tk * self.__tau)]
-            ] + [
-                [coef for coef in self.__inner_coefficients[:-1]] +
-                [self.__inner_coefficients[-1](pillar_line[i - 1], pillar_line[i], pillar_line[i + 1], self.__l0 + i * self.__h, tk * self.__tau)]
-                for i in range(1, self.__n - 1)
-            ] + [
-                [coef for coef in self.__last_coefficients[:-1]] +
-                [self.__last_coefficients[-1](pillar_line[-2], pillar_line[-1], self.__l1, tk * self.__tau)]
-            ]
-
-            self.__prepare_to_run_trough(coefs)
-            self.__run_through(coefs)
-
-            pillar_line = [coefs[i][-1] for i in range(self.__n)]
-            res.append([coefs[i][-1] for i in range(self.__n)])
-
-        sample = [[self.__res_function(self.__l0 + self.__h * dx, self.__tau * dt) for dx in range(self.__n)] for dt in range(self.__k)]
-        errors = [[sample[i][j] - res[i][j] for j in range(self.__n)] for i in range(self.__k)]
+        coefs = np.empty((n, 3))
+        coefs[0] = self.__first_coefficients[:-1]
+        coefs[1:-1] = self.__inner_coefficients
+        coefs[-1] = self.__last_coefficients[:-1]
+        first_fix, last_fix = self.__prepare_to_run_trough(coefs)
+        factors = tma_factor(coefs[:, 0], coefs[:, 1], coefs[:, 2])
+
+        schema = self.__schema_coefficients
+        first_rhs = self.__first_coefficients[-1]
+        last_rhs = self.__last_coefficients[-1]
+        free = _on_grid(self.__free_function, X.shape, x=X, t=T)
+        free_prev = _on_grid(self.__free_function, X.shape, x=X, t=T - self.__tau)
 
+        res = np.empty((self.__k, n))
+        res[0] = _on_grid(self.__t_cond.f, x.shape, x=x)
+        d = np.empty(n)
+
+        for tk in range(1, self.__k):
+            u = res[tk - 1]
+            d[1:-1] = schema['u^k_j-1'] * u[:-2] \
+                + schema['u^k_j'] * u[1:-1] \
+                + schema['u^k_j+1'] * u[2:] \
+                + schema['f^k+1'] * free[tk, 1:-1] \
+                + schema['f^k'] * free_prev[tk, 1:-1]
+            d[0] = first_rhs(u[0], u[1], self.__l0, t[tk])
+            d[-1] = last_rhs(u[-2], u[-1], self.__l1, t[tk])
+            if first_fix is not None:
+                d[0] -= d[first_fix[0]] * first_fix[1]
+            if last_fix is not None:
+                d[-1] -= d[last_fix[0]] * last_fix[1]
+
+            res[tk] = tma_solve(factors, d)
+
+        sample = _on_grid(self.__res_function, X.shape, x=X, t=T)
+        errors = sample - res
+
+        res, sample, errors = res.tolist(), sample.tolist(), errors.tolist()
         return res, sample, errors
 
     # def solve_function_plot_interractor(self, solve, theta, approximation_type, n, k, courant, direction, slice_rate, policy):
+    #     import matplotlib.pyplot as plt
     #     plt.figure(figsize=(15, 10))
 
     #     if solve == 'explict':
@@ -490,6 +517,7 @@ class Task:
     #     plt.grid()
 
     # def solve_error_plot_interractor(self, solve, theta, approximation_type, n, k, courant, direction, slice_rate, policy):
+    #     import matplotlib.pyplot as plt
     #     plt.figure(figsize=(15, 10))
 
     #     if solve == 'explict':
@@ -529,6 +557,7 @@ class Task:
     #     plt.grid()
 
     # def solve_error_aggregate_plot_interractor(self, solve, theta, approximation_type, n, k, courant, policy):
+    #     import matplotlib.pyplot as plt
     #     plt.figure(figsize=(15, 10))
 
     #     if solve == 'explict':
@@ -557,32 +586,46 @@ class Task:
     #     plt.ylabel("error")
     #     plt.grid()
 
-    def calc_all_solves(self, policy, l_border, r_border, step):
-        errors = {}
+    def calc_all_solves(self, policy, l_border, r_border, step, workers=None):
+        """
+        Grid refinement study over all solve and approximation types.
 
+        Independent solves run in a process pool of workers processes
+        (all cores by default). Returns the steps, the max errors and the
+        observed convergence orders between successive grids per type.
+        """
+        solve_types = [solve for solve in self.__solve_types if solve != 'custom']
+        counts = list(range(l_border, r_border, step))
+        steps = [(self.l() if policy == 'n' else self.t()) / i for i in counts]
+        runs = [
+            (solve, approx, i if policy != 'n' else None, i if policy != 'k' else None)
+            for i in counts
+            for solve in solve_types
+            for approx in self.__approximation_types
+        ]
+
+        with ForkPool(self, workers) as pool:
+            max_errors = pool.map(_sweep_error, runs)
+
+        max_errors = np.array(max_errors).reshape(len(counts), len(solve_types), len(self.__approximation_types))
+        h = np.array(steps)
+
+        errors = {}
+        orders = {}
         for solve in self.__solve_types:
             for approx in self.__approximation_types:
                 errors[' '.join([solve, approx])] = []
+                orders[' '.join([solve, approx])] = []
+
+        for si, solve in enumerate(solve_types):
+            for ai, approx in enumerate(self.__approximation_types):
+                err = max_errors[:, si, ai]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    order = np.log(err[:-1] / err[1:]) / np.log(h[:-1] / h[1:])
+                errors[' '.join([solve, approx])] = err.tolist()
+                orders[' '.join([solve, approx])] = order.tolist()
 
-        steps = []
-        for i in range(l_border, r_border, step):
-            steps.append((self.l() if policy == 'n' else self.t()) / i)
-            for solve in self.__solve_types:
-                if solve == 'custom':
-                    continue
-                for approx in self.__approximation_types:
-                    _, _, err = self.solve(
-                        solve_type=solve,
-                        approximation_type=approx,
-                        k=(i if policy != 'n' else None),
-                        n=(i if policy != 'k' else None)
-                    )
-                    merr = 0
-                    for line in err:
-                        for el in line:
-                            merr = max(abs(el), abs(merr))
-                    errors[' '.join([solve, approx])].append(merr)
-        return steps, errors
+        return steps, errors, orders
 
     def l(self):
         return self.__l1 - self.__l0
@@ -0,0 +1,136 @@
+import os
+import copy
+
+import numpy as np
+
+from deadline import Deadline
+from progress import Progress
+from forkpool import ForkPool, shared
+
+
+class _Start:
+    """
+    Stands in for a StateStore, so that a solve resumes from the given layers.
+    """
+
+    def __init__(self, step, layers):
+        self.step = step
+        self.layers = layers
+
+    def nearest(self, key, step):
+        return self.step, self.layers
+
+    def save(self, key, step, layers):
+        pass
+
+
+def _later(func, t0):
+    return lambda *args: func(*args[:-1], args[-1] + t0)
+
+
+def _advance(solver, N, layers, first, last):
+    """
+    Layers 0 to last by the scheme of the solver from the initial condition,
+    or with the layers ending at step first the layers first + 1 to last.
+    A continued solve runs on a copy of the solver with the problem
+    functions of time shifted to start just before the given layers, so
+    its grid has only the rows of these steps.
+    """
+    solver = copy.copy(solver)
+    # solve_func is bound to the original solver
+    solver.solve_func = getattr(solver, solver.solve_func.__name__)
+    if layers is None:
+        solver.store = None
+        return solver.solve_func(N, last + 1, None)
+    shift = first - len(layers)
+    solver.data = copy.copy(solver.data)
+    for name in solver.time_functions:
+        setattr(solver.data, name, _later(getattr(solver.data, name), shift * solver.tau))
+    solver.store = _Start(len(layers), layers)
+    return solver.solve_func(N, last - shift + 1, None)[len(layers) + 1:]
+
+
+def _fine(N, layers, first, last):
+    u = _advance(shared(), N, layers, first, last)
+    return u[first + 1:] if layers is None else u
+
+
+def _restep(layers, ratio):
+    """
+    A state of two layers converted to a time step ratio times larger.
+    """
+    if len(layers) == 1:
+        return layers
+    return np.array([layers[1] - ratio * (layers[1] - layers[0]), layers[1]])
+
+
+def integrate(solver, coarse, N, K, layers, coarsening, slices, tol, iterations, deadline, reporter,
+              workers=None):
+    """
+    Parareal integration over K steps split into time slices. The coarse
+    solver, set up with a coarsening times larger step, predicts the states
+    at the slice boundaries, the fine solver refines every slice in
+    parallel and the predictions are corrected until the boundary states
+    change by less than tol. layers is the number of layers in a state.
+
+    Returns the solution and {'slices', 'iterations', 'converged', 'update'}.
+    """
+    # the deadline and the progress are checked between iterations, never inside a slice
+    for propagator in (solver, coarse):
+        propagator.deadline = Deadline()
+        propagator.reporter = Progress()
+    first = layers - 1
+    length = max(-(-(K - 1 - first) // slices), layers * coarsening)
+    length = -(-length // coarsening) * coarsening
+    bounds = [first] + list(range(length, K - 1, length)) + [K - 1]
+    count = len(bounds) - 1
+
+    def predict(p, state):
+        start, stop = bounds[p] // coarsening, bounds[p + 1] // coarsening
+        if p == 0:
+            u = _advance(coarse, N, None, 0, stop)
+        else:
+            u = _advance(coarse, N, _restep(state, coarsening), start, stop)
+        return _restep(u[-layers:], 1 / coarsening)
+
+    u0 = _advance(solver, N, None, 0, first)
+    states = [u0[:layers]]
+    predictions = []
+    for p in range(count - 1):
+        predictions.append(predict(p, states[p]))
+        states.append(predictions[p])
+
+    fine = [None] * count
+    info = {'slices': count, 'iterations': 0, 'converged': False, 'update': None}
+    with ForkPool(solver, min(workers or os.cpu_count(), count) if count > 1 else 0) as pool:
+        for iteration in range(1, iterations + 1):
+            if deadline.expired():
+                break
+            # slices before iteration - 1 start from exact states and are final
+            todo = range(iteration - 1, count)
+            args = [(N, None if p == 0 else states[p], bounds[p], bounds[p + 1]) for p in todo]
+            results = pool.map(_fine, *zip(*args))
+            for p, result in zip(todo, results):
+                fine[p] = result
+            info['iterations'] = iteration
+
+            update = 0.0
+            for p in range(iteration - 1, count - 1):
+                prediction = predict(p, states[p])
+                state = prediction + fine[p][-layers:] - predictions[p]
+                update = max(update, float(np.max(np.abs(state - states[p + 1]))))
+                predictions[p] = prediction
+                states[p + 1] = state
+            info['update'] = update
+            reporter.report(iteration=iteration, update=update)
+            if update < tol:
+                info['converged'] = True
+                break
+
+    u = np.zeros((K, N), dtype=u0.dtype)
+    u[:layers] = u0
+    for p in range(count):
+        if fine[p] is None:
+            return u[:bounds[p] + 1], info
+        u[bounds[p] + 1:bounds[p + 1] + 1] = fine[p]
+    return u, info
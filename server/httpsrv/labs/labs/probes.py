@@ -0,0 +1,105 @@
+import numpy as np
+
+
+def _locate(coords, h, size, name):
+    """
+    Indices of the grid nodes left of coords and the weights of the right ones.
+    """
+    position = np.asarray(coords, dtype=float) / h
+    if np.any(position < 0) or np.any(position > size - 1):
+        raise Exception(f"Probe {name} is outside of the grid")
+    index = np.minimum(np.floor(position).astype(int), size - 2)
+    return index, position - index
+
+
+class Probes:
+    """
+    Values of a 2D solution at probe points and along probe lines x = const
+    or y = const, recorded while the solver steps. Numerical values are
+    interpolated linearly from the grid, analytic ones are exact.
+
+    spec: {'points': [[x, y], ...], 'lines': [{'x': x} or {'y': y}, ...], 'times': [t, ...]}
+    Without times every step is recorded, otherwise the first step
+    within half a step of each time. Times no step came close to, e.g.
+    beyond the last step or before the snapshot a solve resumed from,
+    are reported as missed.
+    """
+
+    def __init__(self, spec, h1, h2, N1, N2, solution, step):
+        self.x = np.arange(N1) * h1
+        self.y = np.arange(N2) * h2
+        self.solution = solution
+        self.step = step
+
+        self.points = np.asarray(spec.get('points', []), dtype=float).reshape(-1, 2)
+        self.point_i, self.point_wx = _locate(self.points[:, 0], h1, N1, 'x')
+        self.point_j, self.point_wy = _locate(self.points[:, 1], h2, N2, 'y')
+
+        self.lines = []
+        for line in spec.get('lines', []):
+            if 'x' in line:
+                index, weight = _locate([line['x']], h1, N1, 'x')
+                self.lines.append(('x', float(line['x']), index[0], weight[0]))
+            elif 'y' in line:
+                index, weight = _locate([line['y']], h2, N2, 'y')
+                self.lines.append(('y', float(line['y']), index[0], weight[0]))
+            else:
+                raise Exception("Probe line must have x or y")
+
+        self.pending = None if spec.get('times') is None else sorted(float(t) for t in spec['times'])
+        self.missed = []
+        self.times = []
+        self.numerical = []
+        self.analytic = []
+
+    def skip(self, t):
+        """
+        Gives up the times the steps before t were to record.
+        """
+        while self.pending and self.pending[0] <= t - self.step / 2:
+            self.missed.append(self.pending.pop(0))
+
+    def record(self, t, layer):
+        if self.pending is not None:
+            if not self.pending or self.pending[0] > t + self.step / 2:
+                return
+            while self.pending and self.pending[0] <= t + self.step / 2:
+                self.pending.pop(0)
+        self.times.append(t)
+        self.numerical.append(self._interpolate(np.asarray(layer, dtype=float)))
+        self.analytic.append(self._exact(t))
+
+    def _interpolate(self, u):
+        i, j, wx, wy = self.point_i, self.point_j, self.point_wx, self.point_wy
+        points = (1 - wx) * (1 - wy) * u[i, j] + wx * (1 - wy) * u[i + 1, j] + \
+            (1 - wx) * wy * u[i, j + 1] + wx * wy * u[i + 1, j + 1]
+        lines = []
+        for axis, _, index, weight in self.lines:
+            if axis == 'x':
+                lines.append(((1 - weight) * u[index] + weight * u[index + 1]).tolist())
+            else:
+                lines.append(((1 - weight) * u[:, index] + weight * u[:, index + 1]).tolist())
+        return points.tolist(), lines
+
+    def _exact(self, t):
+        points = np.broadcast_to(self.solution(self.points[:, 0], self.points[:, 1], t), len(self.points))
+        lines = []
+        for axis, value, _, _ in self.lines:
+            if axis == 'x':
+                lines.append(np.broadcast_to(self.solution(value, self.y, t), self.y.shape).tolist())
+            else:
+                lines.append(np.broadcast_to(self.solution(self.x, value, t), self.x.shape).tolist())
+        return points.tolist(), lines
+
+    def result(self):
+        """
+        Numerical and analytic values as {'times': [t, ...], 'points': [[value per point] per time],
+        'lines': [[[values along line] per line] per time], 'missed': [t, ...]}.
+        """
+        missed = self.missed + (self.pending or [])
+        return tuple({
+            'times': self.times,
+            'missed': missed,
+            'points': [points for points, _ in values],
+            'lines': [lines for _, lines in values],
+        } for values in (self.numerical, self.analytic))
@@ -0,0 +1,31 @@
+import json
+import sys
+import time
+
+
+def stderr_callback(event):
+    sys.stderr.write(json.dumps(event) + '\n')
+    sys.stderr.flush()
+
+
+class Progress:
+    """
+    Throttled progress events of a long-running solve.
+
+    Solvers call report() on every step or iteration, the callback
+    is invoked at most once per interval seconds.
+    """
+
+    def __init__(self, callback=None, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self.next_report = 0
+
+    def report(self, **event):
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        if now < self.next_report:
+            return
+        self.next_report = now + self.interval
+        self.callback(event)
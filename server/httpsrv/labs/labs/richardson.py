@@ -0,0 +1,32 @@
+import numpy as np
+
+from forkpool import ForkPool, shared
+
+
+def _solve(N, K, T, deadline):
+    solver = shared()
+    u = solver.solve(N, K, T, deadline)
+    return u, solver.truncated
+
+
+def extrapolate(solver, N, K, T, time_factor, ratio, deadline=None):
+    """
+    Richardson extrapolation from the grids (N, K) and (2N, time_factor * K),
+    solved in parallel. ratio is the factor the leading error term drops by
+    between the two grids.
+
+    Returns the extrapolated solution on the coarse grid, the estimate
+    of the error of the fine solution and whether any solve was truncated.
+    """
+    with ForkPool(solver, 1) as pool:
+        future = pool.submit(_solve, 2 * N, time_factor * K, T, deadline)
+        coarse = _solve(N, K, T, deadline)
+        fine = future.result()
+
+    (u_coarse, coarse_truncated), (u_fine, fine_truncated) = coarse, fine
+    u_fine = u_fine[::time_factor, ::2]
+    layers = min(len(u_coarse), len(u_fine))
+    correction = (u_fine[:layers] - u_coarse[:layers]) / (ratio - 1)
+
+    truncated = coarse_truncated or fine_truncated or layers < K
+    return u_fine[:layers] + correction, float(np.max(np.abs(correction))), truncated
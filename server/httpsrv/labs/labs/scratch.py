@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+import numpy as np
+
+SCRATCH_DIR = os.environ.get('LABS_SCRATCH_DIR', os.path.join(tempfile.gettempdir(), 'labs-scratch'))
+
+# rows of an output grid computed at once when it is filled in chunks
+CHUNK_ROWS = 1024
+
+
+def zeros(shape, dtype=np.float64, directory=None):
+    """
+    np.zeros, or with a directory an array memory-mapped from a file there.
+    The file is unlinked right after mapping, its pages live as long as
+    the array and are freed even if the worker is killed.
+    """
+    if directory is None:
+        return np.zeros(shape, dtype=dtype)
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.mmap')
+    try:
+        os.close(fd)
+        return np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+    finally:
+        os.unlink(path)
@@ -0,0 +1,58 @@
+import multiprocessing
+
+import numpy as np
+
+from forkpool import ForkPool, shared
+from decomposition import TYPECODES
+from utils import tma_solve
+
+
+def _shared_array(shape, dtype):
+    rows, cols = shape
+    return np.frombuffer(multiprocessing.RawArray(TYPECODES[np.dtype(dtype)], rows * cols),
+                         dtype=dtype).reshape(rows, cols)
+
+
+def _solve_lines(sweep, start, stop):
+    sweeps = shared()
+    sweeps.solutions[sweep][:, start:stop] = tma_solve(sweeps.factors[sweep], sweeps.rhs[sweep][:, start:stop])
+
+
+class LineSweeps:
+    """
+    Tridiagonal line solves of the ADI half-steps split into chunks of lines,
+    one per worker process. Each sweep solves the systems of factors[i] for
+    every column of rhs[i] into solutions[i]; both live in shared buffers,
+    so only the chunk bounds travel to the workers.
+    """
+
+    def __init__(self, factors, shapes, workers):
+        self.factors = factors
+        # right-hand sides are assembled in float64, solutions are stored in the dtype of the factors
+        self.rhs = [_shared_array(shape, np.float64) for shape in shapes]
+        self.solutions = [_shared_array(shape, f.dtype) for f, shape in zip(factors, shapes)]
+
+        self.chunks = []
+        for rows, lines in shapes:
+            bounds = np.linspace(0, lines, max(min(workers, lines), 1) + 1).astype(int)
+            self.chunks.append([(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start])
+        self.workers = workers
+        self.pool = None
+
+    def __enter__(self):
+        self.pool = ForkPool(self, max(map(len, self.chunks)) if self.workers > 1 else 0).__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.__exit__(*exc)
+        self.pool = None
+
+    def solve(self, sweep):
+        """
+        Solves the lines of rhs[sweep], returns solutions[sweep].
+        """
+        count = len(self.chunks[sweep])
+        if count:
+            starts, stops = zip(*self.chunks[sweep])
+            self.pool.map(_solve_lines, [sweep] * count, starts, stops)
+        return self.solutions[sweep]
@@ -22,21 +22,79 @@ def tma(a, b, c, d):
     return x
 
 
+class TridiagonalFactors:
+    """
+    Forward elimination of a tridiagonal matrix, done once and reused
+    by tma_solve for every right-hand side.
+    """
+
+    def __init__(self, a, b, c, dtype=np.float64):
+        size = len(b)
+        m = [0.0] * size
+        b_ = [float(v) for v in b]
+        for i in range(1, size):
+            m[i] = a[i] / b_[i - 1]
+            b_[i] = b[i] - m[i] * c[i - 1]
+        self.size = size
+        self.m = m
+        self.b = b_
+        self.c = [float(v) for v in c]
+        # the elimination runs in float64, solutions are stored in dtype
+        self.dtype = dtype
+        self.m_array = np.array(m, dtype=dtype)
+        self.b_array = np.array(b_, dtype=dtype)
+        self.c_array = np.array(self.c, dtype=dtype)
+
+
+def tma_factor(a, b, c, dtype=np.float64):
+    return TridiagonalFactors(a, b, c, dtype)
+
+
+def tma_solve(factors, d):
+    """
+    Solves the factored system for d of shape (n,) or for every column of d of shape (n, lines).
+    """
+    size = factors.size
+    if np.ndim(d) == 1:
+        m, b, c = factors.m, factors.b, factors.c
+        x = d.tolist() if isinstance(d, np.ndarray) else list(d)
+        for i in range(1, size):
+            x[i] -= m[i] * x[i - 1]
+        x[-1] /= b[-1]
+        for i in range(size - 2, -1, -1):
+            x[i] = (x[i] - c[i] * x[i + 1]) / b[i]
+        return np.array(x, dtype=factors.dtype)
+
+    m, b, c = factors.m_array, factors.b_array, factors.c_array
+    x = np.array(d, dtype=factors.dtype)
+    for i in range(1, size):
+        x[i] -= m[i] * x[i - 1]
+    x[-1] /= b[-1]
+    for i in range(size - 2, -1, -1):
+        x[i] = (x[i] - c[i] * x[i + 1]) / b[i]
+    return x
+
+
+class Stencil:
+    """
+    Operator of a grid given by the weights of the neighbours of every point,
+    an array of shape (neighbours, rows, cols), e.g. alpha of lab7's
+    _stencil_system. Its inf-norm is the largest sum of the absolute
+    weights of a point, the matrix is never built.
+    """
+
+    def __init__(self, weights):
+        self.weights = np.asarray(weights)
+
+    def norm_inf(self):
+        return float(np.abs(self.weights).sum(axis=0).max(initial=0))
+
+
 def norm_inf(A):
-    n = len(A)
-    norm = 0
-    for i in range(n):
-        sum_ = 0
-        for j in range(n):
-            sum_ += abs(A[i][j])
-        norm = sum_ if norm < sum_ else norm
-    return norm
+    if isinstance(A, Stencil):
+        return A.norm_inf()
+    return np.abs(np.asarray(A)).sum(axis=1).max()
 
 
 def norm_inf_vec(A):
-    n = len(A)
-    norm = 0
-    for i in range(n):
-        if abs(A[i]) > norm:
-            norm = abs(A[i])
-    return norm
\ No newline at end of file
+    return np.max(np.abs(np.asarray(A)), initial=0)